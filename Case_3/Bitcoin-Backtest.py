@@ -8,86 +8,76 @@ import numpy as np
 import matplotlib.pyplot as plt
 get_ipython().magic(u'matplotlib inline')
 import os
-from dateutil.relativedelta import relativedelta
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import r2_score
 from TradeAnalysis import TradeAnalysis
+from autoregressive import CostModel, backtest_autoregressive, lag_matrix, sweep_autoregressive_strat
+from tick_store import TickStore, ingest_csv
+from instrument import NULL_PROFILER, Profiler
+from bar_builder import build_bars, iter_store_chunks
 
 
 # In[9]:
 
-DF = pd.read_csv(os.path.join(os.path.expanduser('~'), 'Downloads', 'btceUSD.csv'), names=['Datetime', 'Price', 'Volume'])
-DF['Datetime'] = pd.to_datetime(DF['Datetime'], unit='s')
-DF.set_index('Datetime', drop=True, inplace=True)
-DF = DF.loc['2015' : ]
-del DF['Volume']
+# The tick csv is converted once into a memory-mapped binary store; later runs only map the dates they use
+STORE_DIR = os.path.join(os.path.expanduser('~'), 'Downloads', 'btceUSD_store')
+if os.path.exists(os.path.join(STORE_DIR, 'meta.json')):
+    STORE = TickStore(STORE_DIR)
+else:
+    STORE = ingest_csv(os.path.join(os.path.expanduser('~'), 'Downloads', 'btceUSD.csv'), STORE_DIR)
+TICKS = STORE.load('2015')
 
 
 # In[10]:
 
-def backtest_autoregressive_strat(look_back, percentile):
+def backtest_autoregressive_strat(look_back, percentile, incremental=False, training_months=None, cost_model=None,
+                                  profiler=NULL_PROFILER, bars=None):
     '''
     This strategy predicts the next price by regressing price on the prior "look_back" number of prices.
     Define "edge" as the magnitude of the difference between the current price and the predicted price.
     Calculate "offset" as the "percentile" quantile of all edges in the training data.
     If the current "edge" is larger than "offset", trade.
     Hold the current position until a trade signal in the oppositite direction is received.
+
+    Each month is traded with a model trained only on the data before it.
+
+    With "incremental", the model is refit each month from running X'X / X'y sums updated with only the
+    new month's rows; the offset is still taken over every training edge under the new fit.
+    With "training_months", only that many months before the test month are used for training.
+    With "cost_model", every change of position is charged fees, slippage and half the spread.
+    With "profiler", the time spent in each stage of the run is recorded.
+    With "bars" (see bar_builder), the strategy trades on bar closes instead of on every tick.
     '''
     
-    # Storing the prices from previous days
-    df = DF.copy()
-    df.rename(columns={'Price': 0}, inplace=True)
-    for i in range(1, look_back+1):
-        df[i] = df[0].shift(i)
-    df.dropna(inplace=True)
-
-    daily_pnl_list = []
-    # Iterating through each month in the data
-    for year in sorted(df.index.year.drop_duplicates().tolist()):
-        for month in sorted(df.index.month.drop_duplicates().tolist()):
-            start_date = pd.to_datetime('{}-{}-{}'.format(year, month, 1), format='%Y-%m-%d')
-            end_date = start_date + relativedelta(months=1)
-            start_date, end_date = str(start_date).split(" ")[0], str(end_date).split(" ")[0]
-            df1 = df[ : start_date] # the training data
-            if not df1.empty:
-                df2 = df[start_date: end_date] # the testing data
-                # fit my autoregressive model
-                ols = LinearRegression().fit(df1[range(1, look_back+1)], df1[0]) 
-                df1['Prediction'] = ols.predict(df1[range(1, look_back+1)])
-                df1['Edge'] = (df1['Prediction'] - df1[1]).abs()
-                # calculate the offset using the training data
-                offset = df1['Edge'].quantile(percentile) 
-                if not df2.empty:
-                    print year, month
-                    # predict using the regression model trained on the training data
-                    df2['Prediction'] = ols.predict(df2[range(1, look_back+1)])
-                    df2['Edge'] = (df2['Prediction'] - df2[1]).abs()
-                    df2['Excess Edge'] = df2['Edge'] - offset
-                    df2['Direction'] = np.where(df2['Prediction'] - df2[1] >= 0, 1, -1)
-                    df2['Position'] = np.nan
-                    df2['Position'] = np.where(df2['Excess Edge'] > 0, df2['Direction'], df2['Position'])
-                    # If we don't get another signal (Excess Edge > 0), our position doesn't change
-                    df2['Position'].fillna(method='ffill', inplace=True)
-                    # We start out with a position of zero
-                    df2['Position'].fillna(0, inplace=True)
-                    df2['Quantity'] = (df2['Position'] - df2['Position'].shift(1)).abs()
-                    df2['P&L'] = (df2[0] - df2[1]) * df2['Position']
-                    # Aggregate P&L for each day
-                    daily_pnl = df2.groupby(df2.index.date)['P&L'].sum().sort_index()
-                    # Print some stats for each month
-                    print 'Sharpe', daily_pnl.mean() / daily_pnl.std() * np.sqrt(252)
-                    print 'Quantity', df2['Quantity'].sum()
-                    print 'R2 train, test', r2_score(df1[0], df1['Prediction']), ',', r2_score(df2[0], df2['Prediction'])
-                    # storing the daily P&L timeseries for each month
-                    daily_pnl_list.append(daily_pnl)
+    if bars is None:
+        timestamps, prices = TICKS.timestamps, TICKS.prices
+    else:
+        timestamps, prices = bars.timestamps, bars.close
+    # Storing the prices from previous days: a view over the tick prices, no copies
+    with profiler.stage('lags', rows=len(prices)):
+        lags = lag_matrix(prices, look_back)
+    # Signals, positions and P&L for every month are computed in one pass over the arrays
+    with profiler.stage('backtest', rows=len(lags)):
+        daily, report = backtest_autoregressive(timestamps[look_back:], lags, look_back, percentile,
+                                                incremental=incremental, training_months=training_months,
+                                                cost_model=cost_model, profiler=profiler)
+    # Print some stats for each month
+    for label, sharpe, quantity, costs, train_r2, test_r2 in report.values:
+        year, month = label.split('-')
+        print int(year), int(month)
+        print 'Sharpe', sharpe
+        print 'Quantity', quantity
+        if cost_model is not None:
+            print 'Costs', costs
+        print 'R2 train, test', train_r2, ',', test_r2
 
     print ""
     print ""
-    # Aggregate the daily data into a single timeseries
-    daily_pnl = pd.concat(daily_pnl_list).fillna(0)
     # Printing the aggregated performance statistics of the strategy
-    TradeAnalysis(daily_pnl, None).print_summary_list('P&L', None)
-    daily_pnl.cumsum().plot()
+    with profiler.stage('summary', rows=len(daily)):
+        if cost_model is None:
+            TradeAnalysis(daily['P&L'], None).print_summary_list('P&L', None)
+        else:
+            TradeAnalysis(daily['P&L'], None, daily['Costs'], daily['Quantity']).print_summary_list('P&L', None)
+    daily['P&L'].cumsum().plot()
     plt.show()
 
 
@@ -98,5 +88,40 @@ backtest_autoregressive_strat(look_back=5, percentile=0.98)
 
 # In[ ]:
 
+# The same strategy after fees, slippage and crossing half of a 10bp spread
+backtest_autoregressive_strat(look_back=5, percentile=0.98, cost_model=CostModel(per_unit_fee=0.5, spread_bps=10))
+
+
+# In[ ]:
+
+# Where the time goes: one JSON line per stage and month in backtest_profile.jsonl, then the breakdown
+with open('backtest_profile.jsonl', 'w') as f:
+    profiler = Profiler(f, track_memory=True)
+    with profiler.stage('load') as record:
+        TICKS = STORE.load('2015')
+        record['rows'] = len(TICKS.prices)
+    backtest_autoregressive_strat(look_back=5, percentile=0.98, profiler=profiler)
+    profiler.close()
+profiler.print_summary()
+
+
+# In[ ]:
+
+# The same strategy on 5 minute bars: the lag matrix and the regressions shrink with the bar count
+BARS = build_bars(iter_store_chunks(STORE, '2015'), 'time', '5m')
+backtest_autoregressive_strat(look_back=5, percentile=0.98, bars=BARS)
+
+
+# In[12]:
+
+# Parameter sweep: every combination runs in its own process on the shared price array
+sweep_stats = sweep_autoregressive_strat(TICKS.timestamps, TICKS.prices,
+                                         look_backs=[1, 2, 3, 5, 8, 13], percentiles=[0.9, 0.95, 0.98, 0.99],
+                                         cost_model=CostModel(per_unit_fee=0.5, spread_bps=10))
+sweep_stats.sort_values('day_sharpe', ascending=False)
+
+
+# In[ ]:
+
 
 
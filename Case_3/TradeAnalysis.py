@@ -1,17 +1,30 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import copy
 import os
 import csv
 import multiprocessing as mp
+from scipy.ndimage import maximum_filter1d
 from scipy.stats import norm
 
+# Order of the statistics returned by TradeAnalysis.get_stats
+STAT_NAMES = ("p_value", "average_win", "average_loss", "risk_reward_ratio", "breakeven_risk_reward_ratio",
+              "win_rate", "breakeven_win_rate", "num_wins", "num_losses", "num_trades", "total_profits",
+              "max_drawdown", "mar", "sortino", "trade_sharpe", "day_sharpe", "turnover", "total_costs", "cost_drag")
+BOOTSTRAP_METRICS = ("day_sharpe", "sortino", "mar", "max_drawdown")
+# relative size of the rounding residue below which rolling variances are taken as 0
+VARIANCE_TOLERANCE = 1e-12
 
 class TradeAnalysis:
 
-    def __init__(self, pnl_list, returns_list):
+    def __init__(self, pnl_list, returns_list, cost_list=None, quantity_list=None):
+        # pnl_list is net of the trading costs in cost_list; quantity_list is the quantity traded each period
         self.pnl_list = pnl_list
         self.returns_list = returns_list
+        self.cost_list = cost_list
+        self.quantity_list = quantity_list
+        self._stats_cache = {}
 
     def get_series(self, series_type):
         if series_type == "P&L":
@@ -22,16 +35,18 @@ class TradeAnalysis:
     
     def calc_running_pnl_list(self, series_type):
         series = self.get_series(series_type)
-        running_pnl_list = []
-        counter = 0
-        for profits in series:
-            counter += profits
-            running_pnl_list.append(counter)
+        running_pnl_list = np.cumsum(np.asarray(series, dtype=float))
         return running_pnl_list
 
-    def plot_running_pnl(self, series_type):
+    def plot_running_pnl(self, series_type, rolling_metrics=None):
         running_pnl = self.calc_running_pnl_list(series_type)
         plt.plot(running_pnl)
+        if rolling_metrics:
+            # rolling curves are aligned with the series, so they share the x axis
+            axis = plt.gca().twinx()
+            for name in rolling_metrics:
+                axis.plot(np.asarray(rolling_metrics[name], dtype=float), label=name, alpha=0.7)
+            axis.legend(loc='best')
         plt.show()
 
     def calc_day_sharpe(self, series_type):
@@ -77,6 +92,67 @@ class TradeAnalysis:
         p_value = 1 - norm.cdf(z_score)
         return p_value
 
+    def calc_bootstrap_samples(self, series_type, account_size, num_resamples=1000, block_size=None,
+                               method="stationary", seed=0, chunk_size=None):
+        '''
+        Day Sharpe, Sortino, MAR and max drawdown of num_resamples bootstrap resamples of the series,
+        one row per resample. Days are resampled in blocks to keep their serial dependence: blocks of
+        random length with mean block_size for the "stationary" bootstrap, of fixed length for
+        "block" (circular moving blocks); block_size defaults to the cube root of the series length.
+        P&L and returns are resampled with the same days, so the drawdowns stay consistent.
+
+        Resample index matrices are generated chunk_size resamples at a time and every metric of a
+        chunk is computed at once on its matrix of resampled columns, so memory is bounded by the
+        chunk. Results are reproducible for a given seed and chunk_size.
+        '''
+        if series_type == "P&L" or series_type == "Returns":
+            stats_type = series_type
+        elif series_type == "Both":
+            stats_type = "Returns"
+        series = np.asarray(self.get_series(stats_type), dtype=float)
+        pnl = np.asarray(self.pnl_list, dtype=float)
+        num_obs = len(series)
+        if block_size is None:
+            block_size = max(1, int(round(num_obs ** (1 / 3.0))))
+        if chunk_size is None:
+            chunk_size = max(1, 2 ** 22 // max(num_obs, 1))
+        rng = np.random.RandomState(seed)
+
+        samples = []
+        for start in range(0, num_resamples, chunk_size):
+            index = _bootstrap_indices(rng, min(chunk_size, num_resamples - start), num_obs, block_size, method)
+            # transposed, each resample is one contiguous column, as in BatchTradeAnalysis
+            arrays = _drawdown_arrays(np.cumsum(pnl[index].T, axis=0), account_size)
+            max_drawdown = arrays["drawdown" if stats_type == "P&L" else "percent_drawdown"][-1]
+            stats = _stats_kernel(series[index].T, max_drawdown)
+            samples.append(np.column_stack([stats[name] for name in BOOTSTRAP_METRICS]))
+        if not samples:
+            return pd.DataFrame([], columns=list(BOOTSTRAP_METRICS))
+        return pd.DataFrame(np.concatenate(samples), columns=list(BOOTSTRAP_METRICS))
+
+    def calc_bootstrap_intervals(self, series_type, account_size, confidence=0.95, **kwargs):
+        '''
+        Percentile bootstrap confidence intervals for day Sharpe, Sortino, MAR and max drawdown, next to
+        the estimates on the full series and the mean and std of the bootstrap distribution. p_value
+        is the share of resamples in which the metric is not positive (not given for max drawdown,
+        which never is). Keyword arguments go to calc_bootstrap_samples.
+        '''
+        samples = self.calc_bootstrap_samples(series_type, account_size, **kwargs)
+        stats = self.calc_stats(series_type, account_size)
+        tail = 100 * (1 - confidence) / 2.0
+        values = samples.values
+        with np.errstate(invalid='ignore'):
+            p_value = np.mean(~(values > 0), axis=0)
+        p_value[list(BOOTSTRAP_METRICS).index("max_drawdown")] = np.nan
+        return pd.DataFrame({"estimate": [stats[name] for name in BOOTSTRAP_METRICS],
+                             "mean": np.nanmean(values, axis=0),
+                             "std": np.nanstd(values, axis=0),
+                             "lower": np.nanpercentile(values, tail, axis=0),
+                             "upper": np.nanpercentile(values, 100 - tail, axis=0),
+                             "p_value": p_value},
+                            index=list(BOOTSTRAP_METRICS),
+                            columns=["estimate", "mean", "std", "lower", "upper", "p_value"])
+
     def calc_num_wins(self, series_type):
         series = self.get_series(series_type)
         num_wins = 0
@@ -138,21 +214,22 @@ class TradeAnalysis:
         breakeven_risk_reward = win_rate / (1 - win_rate)
         return breakeven_risk_reward
 
+    def calc_drawdown_arrays(self, account_size):
+        running_pnl = np.asarray(self.calc_running_pnl_list("P&L"), dtype=float)
+        return _drawdown_arrays(running_pnl, account_size)
+
     def calc_drawdown_list(self, series_type, account_size):
-        running_pnl_list = self.calc_running_pnl_list("P&L")
-        drawdown_list = [0]
-        percent_drawdown_list = [0]
-        for i in range(1, len(running_pnl_list)):
-            drawdown_list.append(min(running_pnl_list[i] - max(running_pnl_list[:i+1]), drawdown_list[-1]))
+        arrays = self.calc_drawdown_arrays(account_size)
         if series_type == "P&L":
-            return drawdown_list
+            return arrays["drawdown"]
         elif series_type == "Returns":
-            for i in range(1, len(running_pnl_list)):
-                percent_drawdown_list.append(min(drawdown_list[i] / float(account_size + max(running_pnl_list[:i+1])), percent_drawdown_list[-1]))
-            return percent_drawdown_list
+            return arrays["percent_drawdown"]
 
     def calc_max_drawdown(self, series_type, account_size):
         drawdown_list = self.calc_drawdown_list(series_type, account_size)
+        if not len(drawdown_list):
+            # an empty series has no drawdown, as when the drawdown list always started at [0]
+            return 0
         max_drawdown = drawdown_list[-1]
         return max_drawdown
 
@@ -166,47 +243,121 @@ class TradeAnalysis:
         return mar
 
     def calc_underwater_graph(self, series_type, account_size):
-        running_pnl_list = self.calc_running_pnl_list("P&L")
-        underwater_graph = []
-        percent_underwater_graph = []
-        for i in range(len(running_pnl_list)):
-            underwater_graph.append(min(0, running_pnl_list[i] - max(running_pnl_list[:i+1])))
+        arrays = self.calc_drawdown_arrays(account_size)
         if series_type == "P&L":
-            return underwater_graph
+            return arrays["underwater"]
         elif series_type == "Returns":
-            for i in range(len(running_pnl_list)):
-                percent_underwater_graph.append(min(0, underwater_graph[i] / float(account_size + max(running_pnl_list[:i+1]))))
-            return percent_underwater_graph
-    
+            return arrays["percent_underwater"]
+
+    def calc_drawdown_episodes(self, series_type, account_size):
+        '''
+        One row per drawdown episode: the index of the peak it starts from, the index of its trough,
+        the index at which the running P&L first regains the peak (-1 if it never does), the depth
+        at the trough and the peak-to-trough, trough-to-recovery and peak-to-recovery durations.
+        '''
+        underwater = self.calc_underwater_graph(series_type, account_size)
+        return _drawdown_episodes(underwater)
+
     def plot_underwater_graph(self, series_type, account_size):
         underwater_graph = self.calc_underwater_graph(series_type, account_size)
         plt.plot(underwater_graph)
         plt.show()
 
+    def calc_rolling_day_sharpe(self, series_type, window):
+        series = self.get_series(series_type)
+        values = np.asarray(series, dtype=float)
+        mean_profits, std_profits = _rolling_moments(values, np.ones(len(values), dtype=bool), window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sharpe = np.where(std_profits == 0, np.nan, mean_profits / std_profits * np.sqrt(252))
+        return _align_rolling(series, sharpe)
+
+    def calc_rolling_trade_sharpe(self, series_type, window):
+        series = self.get_series(series_type)
+        values = np.asarray(series, dtype=float)
+        mean_profits, std_profits = _rolling_moments(values, values != 0, window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sharpe = np.where(std_profits == 0, np.nan, mean_profits / std_profits * np.sqrt(252))
+        return _align_rolling(series, sharpe)
+
+    def calc_rolling_sortino(self, series_type, window, target):
+        series = self.get_series(series_type)
+        values = np.asarray(series, dtype=float)
+        mean_profits = _rolling_sum(values, window) / float(window)
+        downside_deviation = np.sqrt(np.maximum(_rolling_sum(np.minimum(0, values - target) ** 2, window), 0)
+                                     / float(window))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sortino = np.where(downside_deviation == 0, np.nan, mean_profits / downside_deviation * np.sqrt(252))
+        return _align_rolling(series, sortino)
+
+    def calc_rolling_win_rate(self, series_type, window):
+        series = self.get_series(series_type)
+        values = np.asarray(series, dtype=float)
+        num_wins = _rolling_sum((values > 0).astype(float), window)
+        num_losses = _rolling_sum((values < 0).astype(float), window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            win_rate = num_wins / (num_wins + num_losses)
+        return _align_rolling(series, win_rate)
+
+    def calc_rolling_drawdown(self, series_type, window, account_size):
+        '''
+        Distance of the running P&L below its highest point over the trailing window; nan for the
+        first window - 1 rows, like the other rolling metrics.
+        '''
+        running_pnl = self.calc_running_pnl_list("P&L")
+        peak = _trailing_max(running_pnl, window)
+        drawdown = running_pnl - peak
+        if series_type == "Returns":
+            with np.errstate(divide='ignore', invalid='ignore'):
+                drawdown = np.minimum(0, drawdown / (account_size + peak))
+        drawdown[:window - 1] = np.nan
+        return _align_rolling(self.get_series("P&L"), drawdown)
+
+    def calc_stats(self, series_type, account_size):
+        '''
+        Every statistic reported by get_stats and create_summary_list, computed together in one
+        vectorized kernel and cached per (series_type, account_size).
+        '''
+        key = (series_type, account_size)
+        if key not in self._stats_cache:
+            if series_type == "P&L" or series_type == "Returns":
+                stats_type = series_type
+            elif series_type == "Both":
+                stats_type = "Returns"
+            max_drawdown = self.calc_max_drawdown(stats_type, account_size)
+            stats = _stats_kernel(self.get_series(stats_type), max_drawdown)
+            if series_type == "Both":
+                stats["total_profits"] = np.sum(np.asarray(self.pnl_list, dtype=float))
+            stats.update(_cost_stats(self.pnl_list, self.cost_list, self.quantity_list))
+            self._stats_cache[key] = stats
+        return self._stats_cache[key]
+
+    def clear_stats_cache(self):
+        self._stats_cache = {}
+
     def create_summary_list(self, series_type, account_size):
 
-        if series_type == "P&L" or series_type == "Returns":
-            series = self.get_series(series_type)
-            mean_profits = np.mean(series)
-            std_profits = np.std(series)
-            total_profits = np.sum(series)
-
-            day_sharpe = self.calc_day_sharpe(series_type)
-            trade_sharpe = self.calc_trade_sharpe(series_type)
-            downside_deviation = self.calc_downside_deviation(series_type, 0)
-            sortino = self.calc_sortino(series_type, 0)
-            p_value = self.calc_p_value(series_type, 0)
-            max_drawdown = self.calc_max_drawdown(series_type, account_size)
-            mar = self.calc_mar(series_type, account_size)
-            win_rate = self.calc_win_rate(series_type)
-            breakeven_win_rate = self.calc_breakeven_win_rate(series_type)
-            risk_reward_ratio = self.calc_risk_reward_ratio(series_type)
-            breakeven_risk_reward_ratio = self.calc_breakeven_risk_reward_ratio(series_type)
-            num_wins = self.calc_num_wins(series_type)
-            num_losses = self.calc_num_losses(series_type)
-            num_trades = self.calc_num_trades(series_type)
-            average_win = self.calc_average_win(series_type)
-            average_loss = self.calc_average_loss(series_type)
+        if series_type == "P&L" or series_type == "Returns" or series_type == "Both":
+            stats = self.calc_stats(series_type, account_size)
+            mean_profits = stats["mean_profits"]
+            std_profits = stats["std_profits"]
+            total_profits = stats["total_profits"]
+
+            day_sharpe = stats["day_sharpe"]
+            trade_sharpe = stats["trade_sharpe"]
+            downside_deviation = stats["downside_deviation"]
+            sortino = stats["sortino"]
+            p_value = stats["p_value"]
+            max_drawdown = stats["max_drawdown"]
+            mar = stats["mar"]
+            win_rate = stats["win_rate"]
+            breakeven_win_rate = stats["breakeven_win_rate"]
+            risk_reward_ratio = stats["risk_reward_ratio"]
+            breakeven_risk_reward_ratio = stats["breakeven_risk_reward_ratio"]
+            num_wins = stats["num_wins"]
+            num_losses = stats["num_losses"]
+            num_trades = stats["num_trades"]
+            average_win = stats["average_win"]
+            average_loss = stats["average_loss"]
             
             if series_type == "P&L":
                 summary = [("Day Sharpe Ratio", "{0:.2f}".format(day_sharpe)),
@@ -234,7 +385,7 @@ class TradeAnalysis:
                           ("Breakeven Risk-Reward Ratio", "{0:.2f}".format(breakeven_risk_reward_ratio)),
                           ("Average Win", "$"+"{0:.2f}".format(average_win)),
                           ("Average Loss", "$"+"{0:.2f}".format(average_loss))]
-                return summary
+                return summary + self.create_cost_summary_list(stats)
             
             elif series_type == "Returns":
                 summary = [("Day Sharpe Ratio", "{0:.2f}".format(day_sharpe)),
@@ -262,56 +413,44 @@ class TradeAnalysis:
                           ("Breakeven Risk-Reward Ratio", "{0:.2f}".format(breakeven_risk_reward_ratio)),
                           ("Average Win", "{0:.2f}".format(100*average_win)+"%"),
                           ("Average Loss", "{0:.2f}".format(100*average_loss)+"%")]
-                return summary
+                return summary + self.create_cost_summary_list(stats)
 
-        elif series_type == "Both":
-            mean_profits = np.mean(self.returns_list)
-            std_profits = np.std(self.returns_list)
-            total_profits = np.sum(self.pnl_list)
-
-            day_sharpe = self.calc_day_sharpe("Returns")
-            trade_sharpe = self.calc_trade_sharpe("Returns")
-            downside_deviation = self.calc_downside_deviation("Returns", 0)
-            sortino = self.calc_sortino("Returns", 0)
-            p_value = self.calc_p_value("Returns", 0)
-            max_drawdown = self.calc_max_drawdown("Returns", account_size)
-            mar = self.calc_mar("Returns", account_size)
-            win_rate = self.calc_win_rate("Returns")
-            breakeven_win_rate = self.calc_breakeven_win_rate("Returns")
-            risk_reward_ratio = self.calc_risk_reward_ratio("Returns")
-            breakeven_risk_reward_ratio = self.calc_breakeven_risk_reward_ratio("Returns")
-            num_wins = self.calc_num_wins("Returns")
-            num_losses = self.calc_num_losses("Returns")
-            num_trades = self.calc_num_trades("Returns")
-            average_win = self.calc_average_win("Returns")
-            average_loss = self.calc_average_loss("Returns")
-
-            summary = [("Day Sharpe Ratio", "{0:.2f}".format(day_sharpe)),
-                      ("Trade Sharpe Ratio", "{0:.2f}".format(trade_sharpe)),
-                      ("",""),
-                      ("Mean of P&L", "{0:.2f}".format(100*mean_profits)+"%"),
-                      ("Standard Deviation of P&L", "{0:.2f}".format(100*std_profits)+"%"),
-                      ("",""),
-                      ("Sortino Ratio", "{0:.2f}".format(sortino)),
-                      ("Downside Deviation", "{0:.2f}".format(100*downside_deviation)+"%"),
-                      ("",""),
-                      ("Total P&L", "$"+"{:,}".format(int(total_profits))),
-                      ("P-Value", "{0:.3f}".format(p_value)),
-                      ("",""),
-                      ("Maximum Drawdown", "{0:.2f}".format(100*max_drawdown)+"%"),
-                      ("MAR", "{0:.2f}".format(mar)),
-                      ("",""),
-                      ("Win Rate", "{0:.2f}".format(100*win_rate)+"%"),
-                      ("Breakeven Win Rate", "{0:.2f}".format(100*breakeven_win_rate)+"%"),
-                      ("Number of Wins", str(num_wins)),
-                      ("Number of Losses", str(num_losses)),
-                      ("Number of Trades", str(num_trades)),
-                      ("",""),
-                      ("Risk-Reward Ratio", "{0:.2f}".format(risk_reward_ratio)),
-                      ("Breakeven Risk-Reward Ratio", "{0:.2f}".format(breakeven_risk_reward_ratio)),
-                      ("Average Win", "{0:.2f}".format(100*average_win)+"%"),
-                      ("Average Loss", "{0:.2f}".format(100*average_loss)+"%")]
-            return summary
+            elif series_type == "Both":
+                summary = [("Day Sharpe Ratio", "{0:.2f}".format(day_sharpe)),
+                          ("Trade Sharpe Ratio", "{0:.2f}".format(trade_sharpe)),
+                          ("",""),
+                          ("Mean of P&L", "{0:.2f}".format(100*mean_profits)+"%"),
+                          ("Standard Deviation of P&L", "{0:.2f}".format(100*std_profits)+"%"),
+                          ("",""),
+                          ("Sortino Ratio", "{0:.2f}".format(sortino)),
+                          ("Downside Deviation", "{0:.2f}".format(100*downside_deviation)+"%"),
+                          ("",""),
+                          ("Total P&L", "$"+"{:,}".format(int(total_profits))),
+                          ("P-Value", "{0:.3f}".format(p_value)),
+                          ("",""),
+                          ("Maximum Drawdown", "{0:.2f}".format(100*max_drawdown)+"%"),
+                          ("MAR", "{0:.2f}".format(mar)),
+                          ("",""),
+                          ("Win Rate", "{0:.2f}".format(100*win_rate)+"%"),
+                          ("Breakeven Win Rate", "{0:.2f}".format(100*breakeven_win_rate)+"%"),
+                          ("Number of Wins", str(num_wins)),
+                          ("Number of Losses", str(num_losses)),
+                          ("Number of Trades", str(num_trades)),
+                          ("",""),
+                          ("Risk-Reward Ratio", "{0:.2f}".format(risk_reward_ratio)),
+                          ("Breakeven Risk-Reward Ratio", "{0:.2f}".format(breakeven_risk_reward_ratio)),
+                          ("Average Win", "{0:.2f}".format(100*average_win)+"%"),
+                          ("Average Loss", "{0:.2f}".format(100*average_loss)+"%")]
+                return summary + self.create_cost_summary_list(stats)
+
+    def create_cost_summary_list(self, stats):
+        if self.cost_list is None:
+            return []
+        summary = [("",""),
+                   ("Turnover", "{0:.2f}".format(stats["turnover"])),
+                   ("Total Costs", "$"+"{:,}".format(int(stats["total_costs"]))),
+                   ("Cost Drag", "{0:.2f}".format(100*stats["cost_drag"])+"%")]
+        return summary
 
     def print_summary_list(self, series_type, account_size):
         template = "{0:50} {1:20}"
@@ -319,52 +458,447 @@ class TradeAnalysis:
             print template.format(stat[0], stat[1])
             
     def get_stats(self, series_type, account_size):
+        stats = self.calc_stats(series_type, account_size)
+        return [stats[name] for name in STAT_NAMES]
+
+
+def _rolling_sum(values, window):
+    # O(n) regardless of window length; the first window - 1 entries are nan
+    cumulative = np.concatenate(([0.0], np.cumsum(values, dtype=float)))
+    rolling = np.full(len(values), np.nan)
+    if window <= len(values):
+        rolling[window - 1:] = cumulative[window:] - cumulative[:-window]
+    return rolling
+
+
+def _rolling_moments(values, mask, window):
+    # Mean and population std of the masked values in each trailing window. Squares are summed
+    # around the overall mean to keep the cumulative-sum differences well conditioned. The
+    # differences still carry rounding residue of the size of the cumulative sums, so variances
+    # below VARIANCE_TOLERANCE of the running sum of squares are taken as 0 (a constant window, such
+    # as a flat stretch of days); the std is nan for windows with fewer than two masked values.
+    shift = np.mean(values[mask]) if np.any(mask) else 0.0
+    centered = np.where(mask, values - shift, 0)
+    squares = centered ** 2
+    count = _rolling_sum(mask.astype(float), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = _rolling_sum(centered, window) / count
+        variance = _rolling_sum(squares, window) / count - mean ** 2
+        variance[variance <= VARIANCE_TOLERANCE * np.cumsum(squares) / count] = 0
+        std = np.where(count > 1, np.sqrt(variance), np.nan)
+    return mean + shift, std
+
+
+def _trailing_max(values, window):
+    # scipy's running max keeps a monotonic deque, so the cost does not depend on the window;
+    # padding with the first value makes the early windows expanding ones
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return values
+    return maximum_filter1d(values, window, mode='nearest', origin=(window - 1) // 2)
+
+
+def _align_rolling(series, values):
+    if isinstance(series, pd.Series):
+        return pd.Series(values, index=series.index)
+    return values
+
+
+def _bootstrap_indices(rng, num_resamples, num_obs, block_size, method):
+    # (num_resamples, num_obs) day indices. Each row is a sequence of blocks that wrap around the
+    # end of the series; a position's index is the start of its block plus the distance to the last
+    # block start before it, which a running maximum over the block start positions gives at once.
+    positions = np.arange(num_obs)
+    if method == "stationary":
+        new_block = rng.rand(num_resamples, num_obs) < 1.0 / block_size
+        new_block[:, 0] = True
+    elif method == "block":
+        new_block = np.broadcast_to(positions % block_size == 0, (num_resamples, num_obs))
+    else:
+        raise ValueError("unknown bootstrap method {!r}".format(method))
+    block_starts = rng.randint(num_obs, size=(num_resamples, num_obs))
+    last_jump = np.maximum.accumulate(np.where(new_block, positions, 0), axis=1)
+    rows = np.arange(num_resamples)[:, None]
+    return (block_starts[rows, last_jump] + positions - last_jump) % num_obs
+
+
+def _drawdown_arrays(running_pnl, account_size):
+    '''
+    Running-maximum drawdown engine. Works along axis 0, so a 2-D array of running P&L
+    (one column per strategy) is handled the same way as a single series.
+    '''
+    peak = np.maximum.accumulate(running_pnl, axis=0)
+    underwater = running_pnl - peak
+    drawdown = np.minimum.accumulate(underwater, axis=0)
+    arrays = {"running_pnl": running_pnl, "peak": peak, "underwater": underwater, "drawdown": drawdown}
+    if account_size is not None:
+        equity_peak = account_size + peak
+        with np.errstate(divide='ignore', invalid='ignore'):
+            percent_underwater = np.minimum(0, underwater / equity_peak)
+            percent_drawdown = drawdown / equity_peak
+        if len(percent_drawdown):
+            percent_drawdown[0] = 0
+        percent_drawdown = np.minimum.accumulate(percent_drawdown, axis=0)
+        arrays["percent_underwater"] = percent_underwater
+        arrays["percent_drawdown"] = percent_drawdown
+    return arrays
+
+
+def _drawdown_episodes(underwater):
+    underwater = np.asarray(underwater, dtype=float)
+    columns = ["Peak", "Trough", "Recovery", "Depth", "Decline Duration", "Recovery Duration", "Duration"]
+    in_drawdown = (underwater < 0).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], in_drawdown, [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if not len(starts):
+        return pd.DataFrame(columns=columns)
+
+    # the trough of each episode is the first minimum inside its [start, end) span
+    episode = np.repeat(np.arange(len(starts)), ends - starts)
+    positions = np.flatnonzero(in_drawdown)
+    order = np.lexsort((positions, underwater[positions], episode))
+    first = np.concatenate(([0], np.flatnonzero(np.diff(episode[order])) + 1))
+    troughs = positions[order][first]
+
+    peaks = starts - 1
+    recovered = ends < len(underwater)
+    recoveries = np.where(recovered, ends, -1)
+    episodes = pd.DataFrame({"Peak": peaks,
+                             "Trough": troughs,
+                             "Recovery": recoveries,
+                             "Depth": underwater[troughs],
+                             "Decline Duration": troughs - peaks,
+                             "Recovery Duration": np.where(recovered, ends - troughs, -1),
+                             "Duration": np.where(recovered, ends - peaks, -1)},
+                            columns=columns)
+    return episodes
+
+
+def _stats_kernel(series, max_drawdown):
+    '''
+    Computes every moment, count and conditional mean of the series in one vectorized pass.
+    Works along axis 0, so a 2-D array (one column per strategy) gives one value per column.
+    '''
+    series = np.asarray(series, dtype=float)
+    num_obs = series.shape[0]
+    wins = series > 0
+    losses = series < 0
+    trades = wins | losses
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_profits = np.mean(series, axis=0)
+        std_profits = np.std(series, axis=0)
+        total_profits = np.sum(series, axis=0)
+
+        num_wins = np.sum(wins, axis=0)
+        num_losses = np.sum(losses, axis=0)
+        sum_wins = np.sum(np.where(wins, series, 0), axis=0)
+        sum_losses = np.sum(np.where(losses, series, 0), axis=0)
+
+        trade_mean = (sum_wins + sum_losses) / (num_wins + num_losses)
+        trade_std = np.sqrt(np.sum(np.where(trades, series - trade_mean, 0) ** 2, axis=0) / (num_wins + num_losses))
+        downside_deviation = np.sqrt(np.sum(np.minimum(0, series) ** 2, axis=0) / float(num_obs))
+
+    stats = _derive_stats(num_obs, mean_profits, std_profits, total_profits, num_wins, num_losses, sum_wins,
+                          sum_losses, trade_mean, trade_std, downside_deviation, max_drawdown)
+    if series.ndim == 1:
+        stats = dict((name, np.asarray(value)[()]) for name, value in stats.items())
+    return stats
+
+
+def _cost_stats(pnl, costs, quantities):
+    # Turnover is the mean quantity traded per period; cost drag is total costs relative to the size of
+    # the gross (pre-cost) P&L
+    stats = {"turnover": np.nan, "total_costs": np.nan, "cost_drag": np.nan}
+    if quantities is not None:
+        stats["turnover"] = np.mean(np.asarray(quantities, dtype=float), axis=0)
+    if costs is not None:
+        total_costs = np.sum(np.asarray(costs, dtype=float), axis=0)
+        gross_profits = np.sum(np.asarray(pnl, dtype=float), axis=0) + total_costs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats["cost_drag"] = np.where(gross_profits == 0, np.nan, total_costs / np.abs(gross_profits))[()]
+        stats["total_costs"] = total_costs
+    return stats
+
+
+def _derive_stats(num_obs, mean_profits, std_profits, total_profits, num_wins, num_losses, sum_wins, sum_losses,
+                  trade_mean, trade_std, downside_deviation, max_drawdown):
+    # Everything get_stats reports follows from these aggregates, whichever way they were accumulated
+    with np.errstate(divide='ignore', invalid='ignore'):
+        num_trades = num_wins + num_losses
+        day_sharpe = mean_profits / std_profits * np.sqrt(252)
+        trade_sharpe = trade_mean / trade_std * np.sqrt(252)
+        sortino = np.where(downside_deviation == 0, np.nan, mean_profits / downside_deviation * np.sqrt(252))
+        p_value = 1 - norm.cdf(mean_profits / (std_profits / np.sqrt(num_obs)))
+        mar = np.where(max_drawdown == 0, np.nan, mean_profits / np.abs(max_drawdown) * 252)
+
+        win_rate = num_wins / np.asarray(num_trades, dtype=float)
+        average_win = sum_wins / num_wins
+        average_loss = sum_losses / num_losses
+        risk_reward_ratio = np.abs(average_loss / average_win)
+        breakeven_win_rate = risk_reward_ratio / (risk_reward_ratio + 1)
+        breakeven_risk_reward_ratio = np.where(win_rate == 1, np.nan, win_rate / (1 - win_rate))
+
+    stats = {"mean_profits": mean_profits, "std_profits": std_profits, "total_profits": total_profits,
+             "day_sharpe": day_sharpe, "trade_sharpe": trade_sharpe, "downside_deviation": downside_deviation,
+             "sortino": sortino, "p_value": p_value, "max_drawdown": max_drawdown, "mar": mar,
+             "win_rate": win_rate, "breakeven_win_rate": breakeven_win_rate, "risk_reward_ratio": risk_reward_ratio,
+             "breakeven_risk_reward_ratio": breakeven_risk_reward_ratio, "num_wins": num_wins,
+             "num_losses": num_losses, "num_trades": num_trades, "average_win": average_win,
+             "average_loss": average_loss}
+    return stats
+
+
+class BatchTradeAnalysis:
+    '''
+    Analyzes a matrix of strategies at once, one P&L (and optionally returns) column per strategy.
+    Accepts 2-D arrays or DataFrames; the statistics match TradeAnalysis column by column.
+    '''
+
+    def __init__(self, pnl_matrix, returns_matrix=None, cost_matrix=None, quantity_matrix=None):
+        # validated first, so 1-D input gets the ValueError rather than failing on its missing columns
+        self.pnl_matrix = _as_column_matrix(pnl_matrix)
+        self.columns = _matrix_columns(pnl_matrix)
+        self.returns_matrix = None if returns_matrix is None else _as_column_matrix(returns_matrix)
+        self.cost_matrix = None if cost_matrix is None else _as_column_matrix(cost_matrix)
+        self.quantity_matrix = None if quantity_matrix is None else _as_column_matrix(quantity_matrix)
+        self._stats_cache = {}
+
+    def get_series(self, series_type):
+        if series_type == "P&L":
+            series = self.pnl_matrix
+        elif series_type == "Returns":
+            series = self.returns_matrix
+        return series
+
+    def calc_running_pnl_matrix(self, series_type):
+        return np.cumsum(self.get_series(series_type), axis=0)
+
+    def calc_drawdown_arrays(self, account_size):
+        return _drawdown_arrays(self.calc_running_pnl_matrix("P&L"), account_size)
+
+    def calc_max_drawdown(self, series_type, account_size):
+        arrays = self.calc_drawdown_arrays(account_size)
+        if series_type == "P&L":
+            drawdown = arrays["drawdown"]
+        elif series_type == "Returns":
+            drawdown = arrays["percent_drawdown"]
+        return drawdown[-1]
+
+    def calc_stats(self, series_type, account_size):
+        key = (series_type, account_size)
+        if key not in self._stats_cache:
+            if series_type == "P&L" or series_type == "Returns":
+                stats_type = series_type
+            elif series_type == "Both":
+                stats_type = "Returns"
+            max_drawdown = self.calc_max_drawdown(stats_type, account_size)
+            stats = _stats_kernel(self.get_series(stats_type), max_drawdown)
+            if series_type == "Both":
+                stats["total_profits"] = np.sum(self.pnl_matrix, axis=0)
+            stats.update(_cost_stats(self.pnl_matrix, self.cost_matrix, self.quantity_matrix))
+            self._stats_cache[key] = stats
+        return self._stats_cache[key]
+
+    def get_stats(self, series_type, account_size):
+        stats = self.calc_stats(series_type, account_size)
+        return pd.DataFrame(dict((name, stats[name]) for name in STAT_NAMES),
+                            index=self.columns, columns=list(STAT_NAMES))
+
+
+def _matrix_columns(matrix):
+    if isinstance(matrix, pd.DataFrame):
+        return matrix.columns
+    return pd.RangeIndex(np.shape(matrix)[1])
+
+
+def _as_column_matrix(matrix):
+    # Column-major storage keeps each strategy contiguous, so reductions along axis 0 run the
+    # same summation as they do on a single series and the numbers agree with TradeAnalysis.
+    matrix = np.asfortranarray(matrix, dtype=float)
+    if matrix.ndim != 2:
+        raise ValueError("expected a 2-D matrix with one column per strategy")
+    return matrix
+
+
+class StreamingTradeAnalysis:
+    '''
+    Incremental version of TradeAnalysis for live P&L feeds. Each update costs O(1) time and memory,
+    and get_stats reports the same statistics as TradeAnalysis over everything seen so far.
+    Accumulators over consecutive shards can be combined with merge.
+    '''
+
+    def __init__(self, account_size=None):
+        self.account_size = account_size
+        self.moments = {"P&L": _StreamingMoments(), "Returns": _StreamingMoments()}
+        self.num_obs = 0
+        self.running_pnl = 0.0
+        self.peak = -np.inf
+        self.min_running_pnl = np.inf
+        self.max_drawdown = 0.0
+        self.percent_max_drawdown = 0.0
+        self.total_costs = None
+        self.total_quantity = None
+
+    def update(self, pnl, returns=None, cost=None, quantity=None):
+        self.moments["P&L"].update(pnl)
+        if returns is not None:
+            self.moments["Returns"].update(returns)
+        if cost is not None:
+            self.total_costs = (self.total_costs or 0.0) + cost
+        if quantity is not None:
+            self.total_quantity = (self.total_quantity or 0.0) + quantity
+
+        self.running_pnl += pnl
+        self.peak = max(self.peak, self.running_pnl)
+        self.min_running_pnl = min(self.min_running_pnl, self.running_pnl)
+        self.max_drawdown = min(self.max_drawdown, self.running_pnl - self.peak)
+        if self.account_size is not None and self.num_obs > 0:
+            percent_drawdown = self.max_drawdown / float(self.account_size + self.peak)
+            self.percent_max_drawdown = min(self.percent_max_drawdown, percent_drawdown)
+        self.num_obs += 1
+
+    def update_many(self, pnl_list, returns_list=None, cost_list=None, quantity_list=None):
+        for i in range(len(pnl_list)):
+            self.update(pnl_list[i], None if returns_list is None else returns_list[i],
+                        None if cost_list is None else cost_list[i],
+                        None if quantity_list is None else quantity_list[i])
+
+    def merge(self, other):
+        '''
+        Combines this accumulator with one that saw the observations immediately following it.
+        Percent drawdown depends on the peak at every step, so it cannot be recovered from two
+        non-empty shards and is reported as nan after such a merge.
+        '''
+        if other.num_obs == 0:
+            return copy.deepcopy(self)
+        if self.num_obs == 0:
+            return copy.deepcopy(other)
+        merged = StreamingTradeAnalysis(self.account_size)
+        for series_type in merged.moments:
+            merged.moments[series_type] = self.moments[series_type].merge(other.moments[series_type])
+        merged.num_obs = self.num_obs + other.num_obs
+        merged.running_pnl = self.running_pnl + other.running_pnl
+        merged.peak = max(self.peak, self.running_pnl + other.peak)
+        merged.min_running_pnl = min(self.min_running_pnl, self.running_pnl + other.min_running_pnl)
+        # the deepest point of the second shard measured against the first shard's peak
+        merged.max_drawdown = min(self.max_drawdown, other.max_drawdown,
+                                  self.running_pnl + other.min_running_pnl - self.peak)
+        merged.percent_max_drawdown = np.nan
+        merged.total_costs = _add_optional(self.total_costs, other.total_costs)
+        merged.total_quantity = _add_optional(self.total_quantity, other.total_quantity)
+        return merged
+
+    def calc_max_drawdown(self, series_type, account_size):
+        if series_type == "P&L":
+            return self.max_drawdown
+        elif series_type == "Returns":
+            if account_size != self.account_size:
+                raise ValueError("percent drawdown is only tracked for the account size given at construction")
+            return self.percent_max_drawdown
+
+    def calc_stats(self, series_type, account_size):
         if series_type == "P&L" or series_type == "Returns":
-            series = self.get_series(series_type)
-            mean_profits = np.mean(series)
-            std_profits = np.std(series)
-            total_profits = np.sum(series)
-
-            day_sharpe = self.calc_day_sharpe(series_type)
-            trade_sharpe = self.calc_trade_sharpe(series_type)
-            downside_deviation = self.calc_downside_deviation(series_type, 0)
-            sortino = self.calc_sortino(series_type, 0)
-            p_value = self.calc_p_value(series_type, 0)
-            max_drawdown = self.calc_max_drawdown(series_type, account_size)
-            mar = self.calc_mar(series_type, account_size)
-            win_rate = self.calc_win_rate(series_type)
-            breakeven_win_rate = self.calc_breakeven_win_rate(series_type)
-            risk_reward_ratio = self.calc_risk_reward_ratio(series_type)
-            breakeven_risk_reward_ratio = self.calc_breakeven_risk_reward_ratio(series_type)
-            num_wins = self.calc_num_wins(series_type)
-            num_losses = self.calc_num_losses(series_type)
-            num_trades = self.calc_num_trades(series_type)
-            average_win = self.calc_average_win(series_type)
-            average_loss = self.calc_average_loss(series_type)
-        
+            stats_type = series_type
         elif series_type == "Both":
-            mean_profits = np.mean(self.returns_list)
-            std_profits = np.mean(self.returns_list)
-            total_profits = np.sum(self.pnl_list)
-
-            day_sharpe = self.calc_day_sharpe("Returns")
-            trade_sharpe = self.calc_trade_sharpe("Returns")
-            downside_deviation = self.calc_downside_deviation("Returns", 0)
-            sortino = self.calc_sortino("Returns", 0)
-            p_value = self.calc_p_value("Returns", 0)
-            max_drawdown = self.calc_max_drawdown("Returns", account_size)
-            mar = self.calc_mar("Returns", account_size)
-            win_rate = self.calc_win_rate("Returns")
-            breakeven_win_rate = self.calc_breakeven_win_rate("Returns")
-            risk_reward_ratio = self.calc_risk_reward_ratio("Returns")
-            breakeven_risk_reward_ratio = self.calc_breakeven_risk_reward_ratio("Returns")
-            num_wins = self.calc_num_wins("Returns")
-            num_losses = self.calc_num_losses("Returns")
-            num_trades = self.calc_num_trades("Returns")
-            average_win = self.calc_average_win("Returns")
-            average_loss = self.calc_average_loss("Returns")
-            
-        stats = [p_value, average_win, average_loss, risk_reward_ratio, breakeven_risk_reward_ratio, win_rate,
-                 breakeven_win_rate, num_wins, num_losses, num_trades, total_profits, max_drawdown, mar,
-                 sortino, trade_sharpe, day_sharpe]
+            stats_type = "Returns"
+        moments = self.moments[stats_type]
+        stats = moments.derive_stats(self.calc_max_drawdown(stats_type, account_size))
+        if series_type == "Both":
+            stats["total_profits"] = self.moments["P&L"].total
+        stats.update(self.calc_cost_stats())
+        return stats
+
+    def calc_cost_stats(self):
+        stats = {"turnover": np.nan, "total_costs": np.nan, "cost_drag": np.nan}
+        if self.total_quantity is not None and self.num_obs:
+            stats["turnover"] = self.total_quantity / float(self.num_obs)
+        if self.total_costs is not None:
+            gross_profits = self.moments["P&L"].total + self.total_costs
+            stats["total_costs"] = self.total_costs
+            stats["cost_drag"] = self.total_costs / abs(gross_profits) if gross_profits != 0 else np.nan
         return stats
+
+    def get_stats(self, series_type, account_size):
+        stats = self.calc_stats(series_type, account_size)
+        return [stats[name] for name in STAT_NAMES]
+
+
+class _StreamingMoments:
+    # Welford running moments over all observations and over the non-zero (trade) observations
+
+    def __init__(self):
+        self.num_obs = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.total = 0.0
+        self.num_trades = 0
+        self.trade_mean = 0.0
+        self.trade_m2 = 0.0
+        self.downside_sum_sq = 0.0
+        self.num_wins = 0
+        self.num_losses = 0
+        self.sum_wins = 0.0
+        self.sum_losses = 0.0
+
+    def update(self, value):
+        self.num_obs += 1
+        delta = value - self.mean
+        self.mean += delta / self.num_obs
+        self.m2 += delta * (value - self.mean)
+        self.total += value
+        if value < 0:
+            self.downside_sum_sq += value * value
+            self.num_losses += 1
+            self.sum_losses += value
+        elif value > 0:
+            self.num_wins += 1
+            self.sum_wins += value
+        if value != 0:
+            self.num_trades += 1
+            delta = value - self.trade_mean
+            self.trade_mean += delta / self.num_trades
+            self.trade_m2 += delta * (value - self.trade_mean)
+
+    def merge(self, other):
+        merged = _StreamingMoments()
+        merged.num_obs, merged.mean, merged.m2 = _merge_moments(self.num_obs, self.mean, self.m2,
+                                                                other.num_obs, other.mean, other.m2)
+        merged.num_trades, merged.trade_mean, merged.trade_m2 = _merge_moments(
+            self.num_trades, self.trade_mean, self.trade_m2, other.num_trades, other.trade_mean, other.trade_m2)
+        merged.total = self.total + other.total
+        merged.downside_sum_sq = self.downside_sum_sq + other.downside_sum_sq
+        merged.num_wins = self.num_wins + other.num_wins
+        merged.num_losses = self.num_losses + other.num_losses
+        merged.sum_wins = self.sum_wins + other.sum_wins
+        merged.sum_losses = self.sum_losses + other.sum_losses
+        return merged
+
+    def derive_stats(self, max_drawdown):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.mean if self.num_obs else np.nan
+            std = np.sqrt(np.float64(self.m2) / self.num_obs)
+            trade_mean = self.trade_mean if self.num_trades else np.nan
+            trade_std = np.sqrt(np.float64(self.trade_m2) / self.num_trades)
+            downside_deviation = np.sqrt(np.float64(self.downside_sum_sq) / self.num_obs)
+        stats = _derive_stats(self.num_obs, mean, std, self.total, self.num_wins, self.num_losses,
+                              np.float64(self.sum_wins), np.float64(self.sum_losses), trade_mean, trade_std,
+                              downside_deviation, max_drawdown)
+        return dict((name, np.asarray(value)[()]) for name, value in stats.items())
+
+
+def _add_optional(a, b):
+    if a is None and b is None:
+        return None
+    return (a or 0.0) + (b or 0.0)
+
+
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    # Chan et al. pairwise combination of Welford accumulators
+    count = count_a + count_b
+    if count == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / float(count)
+    m2 = m2_a + m2_b + delta * delta * count_a * count_b / float(count)
+    return count, mean, m2
@@ -0,0 +1,327 @@
+import itertools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from sklearn.metrics import r2_score
+from TradeAnalysis import TradeAnalysis, STAT_NAMES
+from instrument import NULL_PROFILER
+
+DAILY_COLUMNS = ['P&L', 'Costs', 'Quantity']
+REPORT_COLUMNS = ['Month', 'Sharpe', 'Quantity', 'Costs', 'R2 Train', 'R2 Test']
+
+
+class IncrementalOLS:
+    '''
+    Least squares with an intercept, fitted from running X'X and X'y sums so that rows can be
+    added (update) or dropped (downdate) without revisiting the rest of the training data.
+    Exposes intercept_, coef_ and predict like sklearn's LinearRegression.
+    '''
+
+    def __init__(self, num_features, shift=0.0):
+        # Prices are large and the lags nearly collinear, so sums are taken around a fixed shift
+        # (e.g. the first price) to keep the normal equations well conditioned.
+        self.num_features = num_features
+        self.shift = shift
+        self.num_obs = 0
+        self.sum_x = np.zeros(num_features)
+        self.sum_y = 0.0
+        self.xtx = np.zeros((num_features, num_features))
+        self.xty = np.zeros(num_features)
+        self.yty = 0.0
+        self.intercept_ = np.nan
+        self.coef_ = np.full(num_features, np.nan)
+
+    def update(self, X, y, sign=1):
+        X = np.asarray(X, dtype=float) - self.shift
+        y = np.asarray(y, dtype=float) - self.shift
+        self.num_obs += sign * len(y)
+        self.sum_x += sign * X.sum(axis=0)
+        self.sum_y += sign * y.sum()
+        self.xtx += sign * np.dot(X.T, X)
+        self.xty += sign * np.dot(X.T, y)
+        self.yty += sign * np.dot(y, y)
+        return self
+
+    def downdate(self, X, y):
+        return self.update(X, y, sign=-1)
+
+    def fit(self):
+        mean_x = self.sum_x / self.num_obs
+        mean_y = self.sum_y / self.num_obs
+        sxx = self.xtx - self.num_obs * np.outer(mean_x, mean_x)
+        sxy = self.xty - self.num_obs * mean_x * mean_y
+        self.coef_ = np.linalg.lstsq(sxx, sxy, rcond=None)[0]
+        self.intercept_ = mean_y - np.dot(mean_x, self.coef_) + self.shift * (1 - self.coef_.sum())
+        return self
+
+    def predict(self, X):
+        return np.dot(np.asarray(X, dtype=float), self.coef_) + self.intercept_
+
+    def score(self):
+        # in-sample R^2 straight from the sufficient statistics
+        mean_x = self.sum_x / self.num_obs
+        mean_y = self.sum_y / self.num_obs
+        sxx = self.xtx - self.num_obs * np.outer(mean_x, mean_x)
+        sxy = self.xty - self.num_obs * mean_x * mean_y
+        syy = self.yty - self.num_obs * mean_y ** 2
+        residual = syy - 2 * np.dot(self.coef_, sxy) + np.dot(self.coef_, np.dot(sxx, self.coef_))
+        return 1 - residual / syy
+
+
+class WalkForwardAutoregression:
+    '''
+    Keeps an autoregressive fit current as the training window moves forward: only the rows entering
+    (and, for a rolling window, leaving) the window update the least-squares sums.
+
+    The edge-quantile offset is taken over every training row re-scored with the current fit, as in
+    the full refit, so the incremental mode trades the same strategy; re-scoring is one pass of
+    predictions over the window, without the fit.
+    '''
+
+    def __init__(self, X, y, percentile):
+        self.X = np.asarray(X, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.percentile = percentile
+        self.ols = IncrementalOLS(self.X.shape[1], shift=self.y[0] if len(self.y) else 0.0)
+        self.start = 0
+        self.stop = 0
+
+    def advance(self, start, stop):
+        '''Moves the training window to rows [start, stop) and refits.'''
+        if start < self.start or stop < self.stop:
+            raise ValueError("the training window can only move forward")
+        dropped = slice(self.start, min(start, self.stop))
+        self.ols.downdate(self.X[dropped], self.y[dropped])
+        added = slice(max(start, self.stop), stop)
+        self.ols.update(self.X[added], self.y[added])
+        self.start, self.stop = start, stop
+        if self.ols.num_obs:
+            self.ols.fit()
+        return self
+
+    @property
+    def offset(self):
+        # the percentile quantile of the edges of the training rows under the current fit
+        if not self.ols.num_obs:
+            return np.nan
+        train = slice(self.start, self.stop)
+        edges = np.abs(self.ols.predict(self.X[train]) - self.X[train, 0])
+        return np.percentile(edges, 100 * self.percentile)
+
+    @property
+    def train_r2(self):
+        return self.ols.score()
+
+
+class CostModel:
+    '''
+    Trading costs charged on every change of position: a fee and a fixed slippage per unit traded,
+    plus half of a bid-ask spread quoted in basis points of the price.
+    '''
+
+    def __init__(self, per_unit_fee=0.0, spread_bps=0.0, slippage=0.0):
+        self.per_unit_fee = per_unit_fee
+        self.spread_bps = spread_bps
+        self.slippage = slippage
+
+    def costs(self, quantity, price):
+        return quantity * (self.per_unit_fee + self.slippage + price * self.spread_bps / 2e4)
+
+
+def lag_matrix(prices, look_back):
+    '''
+    Zero-copy view of the prices with column i holding the price i steps back.
+    Row r corresponds to prices[look_back + r].
+    '''
+    prices = np.ascontiguousarray(prices, dtype=float)
+    num_rows = len(prices) - look_back
+    stride = prices.strides[0]
+    return np.lib.stride_tricks.as_strided(prices[look_back:], shape=(num_rows, look_back + 1),
+                                           strides=(stride, -stride), writeable=False)
+
+
+def backtest_autoregressive(timestamps, lags, look_back, percentile, incremental=False, training_months=None,
+                            cost_model=None, profiler=None):
+    '''
+    Array version of backtest_autoregressive_strat on a lag matrix (column 0 the price, column i the
+    price i steps back). Each month is traded with a model trained on the rows before it.
+    Returns daily P&L (net of the cost_model's costs), costs and quantity traded, and a per-month
+    report of Sharpe, quantity, costs and train/test R^2.
+
+    Only the model fits loop over months; they write predictions into one array over the whole
+    test span, and signals, positions, P&L and the report are then computed in a single pass with
+    month boundaries given by row offsets.
+
+    A Profiler (see instrument.py) times the fit and quantile of each month and the positions,
+    daily groupby and report stages.
+    '''
+    profiler = NULL_PROFILER if profiler is None else profiler
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind != 'M':
+        timestamps = timestamps.astype('datetime64[ns]')
+    X = lags[:, 1:look_back+1]
+    y = lags[:, 0]
+    months = timestamps.astype('datetime64[M]')
+    month_starts = np.flatnonzero(np.concatenate(([True], months[1:] != months[:-1])))
+    bounds = np.append(month_starts, len(y))
+
+    traded, offsets, train_r2, prediction = _fit_months(timestamps, months, X, y, bounds, percentile,
+                                                        incremental, training_months, profiler)
+    if not len(traded):
+        return pd.DataFrame([], columns=DAILY_COLUMNS, dtype=float), pd.DataFrame([], columns=REPORT_COLUMNS)
+
+    # every month after the first one with training data is traded, so the test span is contiguous
+    span = slice(bounds[traded[0]], len(y))
+    test_bounds = bounds[traded[0]:] - span.start
+    price, last_price, times = y[span], X[span, 0], timestamps[span]
+    row_offset = np.repeat(offsets, np.diff(test_bounds))
+
+    with profiler.stage('positions', rows=len(price)):
+        edge = np.abs(prediction - last_price)
+        direction = np.where(prediction - last_price >= 0, 1, -1)
+        month_start = np.zeros(len(price), dtype=bool)
+        month_start[test_bounds[:-1]] = True
+        position = _hold_until_opposite(edge > row_offset, direction, month_start)
+        quantity = np.abs(np.diff(np.concatenate(([0], position))))
+        # positions change at the current price, so that is what the trade costs are charged on; this
+        # includes the change at the first row of a month, from the previous month's last position
+        costs = np.zeros(len(price)) if cost_model is None else cost_model.costs(quantity, price)
+        # the report counts the first row of a month as having no prior position in the month,
+        # matching the shift(1) in the notebook
+        report_quantity = np.where(month_start, 0, quantity)
+        pnl = (price - last_price) * position - costs
+
+    with profiler.stage('daily_groupby', rows=len(price)) as record:
+        daily, day_starts = _sum_by_day(times, np.column_stack((pnl, costs, quantity)))
+        daily = daily.fillna(0)
+        record['days'] = len(daily)
+    with profiler.stage('report', rows=len(traded)):
+        report = _monthly_report(months[span][test_bounds[:-1]], test_bounds, day_starts, daily['P&L'].values,
+                                 report_quantity, costs, price, prediction, train_r2)
+    return daily, report
+
+
+def _fit_months(timestamps, months, X, y, bounds, percentile, incremental, training_months, profiler=NULL_PROFILER):
+    # Fits one model per month on the rows before it and writes its predictions for that month
+    # straight into a preallocated array over the test span.
+    if incremental:
+        walk_forward = WalkForwardAutoregression(X, y, percentile)
+    traded, offsets, train_r2 = [], [], []
+    prediction = None
+    for m in range(len(bounds) - 1):
+        train_start, train_stop = 0, bounds[m]
+        if training_months is not None:
+            window_start = (months[bounds[m]] - np.timedelta64(training_months, 'M')).astype(timestamps.dtype)
+            train_start = np.searchsorted(timestamps, window_start)
+        if train_stop <= train_start and not traded:
+            continue
+        if prediction is None:
+            prediction = np.empty(len(y) - bounds[m])
+            first = bounds[m]
+        test = slice(bounds[m], bounds[m+1])
+        if train_stop <= train_start:
+            # a gap in the data left this month without training rows: stay flat
+            prediction[test.start - first:test.stop - first] = X[test, 0]
+            traded.append(m)
+            offsets.append(np.inf)
+            train_r2.append(np.nan)
+            continue
+        month = str(months[bounds[m]])
+        if incremental:
+            with profiler.stage('fit', rows=train_stop - train_start, month=month):
+                ols = walk_forward.advance(train_start, train_stop).ols
+                r2 = walk_forward.train_r2
+            with profiler.stage('quantile', rows=train_stop - train_start, month=month):
+                offset = walk_forward.offset
+        else:
+            train = slice(train_start, train_stop)
+            with profiler.stage('fit', rows=train_stop - train_start, month=month):
+                ols = LinearRegression().fit(X[train], y[train])
+                train_prediction = ols.predict(X[train])
+                r2 = r2_score(y[train], train_prediction)
+            with profiler.stage('quantile', rows=train_stop - train_start, month=month):
+                offset = np.percentile(np.abs(train_prediction - X[train, 0]), 100 * percentile)
+        with profiler.stage('predict', rows=test.stop - test.start, month=month):
+            prediction[test.start - first:test.stop - first] = ols.predict(X[test])
+        traded.append(m)
+        offsets.append(offset)
+        train_r2.append(r2)
+    return (np.asarray(traded, dtype=int), np.asarray(offsets, dtype=float), np.asarray(train_r2, dtype=float),
+            prediction)
+
+
+def _hold_until_opposite(signal, direction, reset):
+    # forward-fill the direction of the last signal, going flat at every reset until the next one
+    last_event = np.maximum.accumulate(np.where(signal | reset, np.arange(len(signal)), 0))
+    return np.where(signal[last_event], direction[last_event], 0)
+
+
+def _sum_by_day(timestamps, values):
+    days = timestamps.astype('datetime64[D]')
+    day_starts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+    daily = pd.DataFrame(np.add.reduceat(values, day_starts, axis=0), index=pd.DatetimeIndex(days[day_starts]).date,
+                         columns=DAILY_COLUMNS)
+    return daily, day_starts
+
+
+def _monthly_report(month_labels, test_bounds, day_starts, daily_pnl, quantity, costs, price, prediction,
+                    train_r2):
+    month_starts = test_bounds[:-1]
+    # days never straddle months, so each month's days are a contiguous run of daily_pnl
+    day_month = np.searchsorted(month_starts, day_starts, side='right') - 1
+    num_days = np.bincount(day_month, minlength=len(month_starts)).astype(float)
+    day_mean = np.bincount(day_month, daily_pnl, minlength=len(month_starts)) / num_days
+    day_var = np.bincount(day_month, (daily_pnl - day_mean[day_month]) ** 2, minlength=len(month_starts))
+    month_lengths = np.diff(test_bounds)
+    sse = np.add.reduceat((price - prediction) ** 2, month_starts)
+    price_mean = np.add.reduceat(price, month_starts) / month_lengths.astype(float)
+    sst = np.add.reduceat((price - np.repeat(price_mean, month_lengths)) ** 2, month_starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # pandas' std is the sample one
+        sharpe = day_mean / np.sqrt(day_var / (num_days - 1)) * np.sqrt(252)
+        test_r2 = 1 - sse / sst
+    return pd.DataFrame({'Month': [str(m) for m in month_labels],
+                         'Sharpe': sharpe,
+                         'Quantity': np.add.reduceat(quantity, month_starts),
+                         'Costs': np.add.reduceat(costs, month_starts),
+                         'R2 Train': train_r2,
+                         'R2 Test': test_r2},
+                        columns=REPORT_COLUMNS)
+
+
+def sweep_autoregressive_strat(timestamps, prices, look_backs, percentiles, processes=None, **kwargs):
+    '''
+    Runs the autoregressive backtest for every (look_back, percentile) combination over a process
+    pool and collects TradeAnalysis.get_stats of each daily P&L series into one table. Keyword
+    arguments (e.g. a cost_model) are passed on to backtest_autoregressive.
+    Workers receive the timestamp and price arrays once, when the pool starts, and each builds the
+    lag matrix for the largest look_back as a view that smaller look_backs slice.
+    '''
+    combinations = list(itertools.product(look_backs, percentiles))
+    initargs = (np.asarray(timestamps), np.asarray(prices, dtype=float),
+                max(look_backs), kwargs)
+    pool = mp.Pool(processes, initializer=_init_sweep_worker, initargs=initargs)
+    try:
+        results = pool.map(_run_sweep_task, combinations)
+    finally:
+        pool.close()
+        pool.join()
+    index = pd.MultiIndex.from_tuples(combinations, names=['look_back', 'percentile'])
+    return pd.DataFrame(results, index=index, columns=list(STAT_NAMES))
+
+
+_SWEEP_DATA = {}
+
+
+def _init_sweep_worker(timestamps, prices, max_look_back, kwargs):
+    _SWEEP_DATA['timestamps'] = timestamps[max_look_back:]
+    _SWEEP_DATA['lags'] = lag_matrix(prices, max_look_back)
+    _SWEEP_DATA['kwargs'] = kwargs
+
+
+def _run_sweep_task(combination):
+    look_back, percentile = combination
+    lags = _SWEEP_DATA['lags'][:, :look_back+1]
+    daily, _ = backtest_autoregressive(_SWEEP_DATA['timestamps'], lags, look_back, percentile, **_SWEEP_DATA['kwargs'])
+    return TradeAnalysis(daily['P&L'], None, daily['Costs'], daily['Quantity']).get_stats('P&L', None)
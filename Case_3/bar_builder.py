@@ -0,0 +1,120 @@
+import collections
+import numpy as np
+import pandas as pd
+from tick_store import COLUMNS, TickSlice
+
+Bars = collections.namedtuple("Bars", ["timestamps", "open", "high", "low", "close", "volume", "ticks"])
+
+BAR_KINDS = ("time", "volume", "ticks")
+
+
+class BarBuilder:
+    '''
+    Aggregates a tick stream into OHLCV bars in one pass. kind is "time" (size a duration such as
+    "1m", "5m", "1h", or seconds; bars are aligned to multiples of it and empty intervals produce no
+    bar), "volume" (a bar closes with the tick that brings the cumulative volume to the next multiple
+    of size) or "ticks" (size ticks per bar). Each bar is stamped with the time of its last tick, so
+    its close is known at its timestamp.
+
+    update takes the ticks chunk by chunk and returns the bars completed so far; the last bar of a
+    chunk may continue in the next one, so it is carried over and only returned once a later tick
+    belongs to another bar, or by flush at the end of the stream.
+    '''
+
+    def __init__(self, kind, size):
+        if kind not in BAR_KINDS:
+            raise ValueError("unknown bar kind {!r}".format(kind))
+        if kind == "time" and not isinstance(size, (int, float, np.number)):
+            size = pd.Timedelta(size).total_seconds()
+        if not size > 0:
+            raise ValueError("bar size must be positive")
+        self.kind = kind
+        self.size = size
+        self.partial = None
+        self._volume = 0.0
+        self._ticks = 0
+
+    def update(self, timestamps, prices, volumes):
+        timestamps = np.asarray(timestamps)
+        prices = np.asarray(prices, dtype=float)
+        volumes = np.asarray(volumes, dtype=float)
+        if not len(prices):
+            return _empty_bars(timestamps.dtype)
+        ids = self._bar_ids(timestamps, volumes)
+
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        ends = np.append(starts[1:], len(ids)) - 1
+        bars = {"id": ids[starts],
+                "timestamps": timestamps[ends],
+                "open": prices[starts],
+                "high": np.maximum.reduceat(prices, starts),
+                "low": np.minimum.reduceat(prices, starts),
+                "close": prices[ends],
+                "volume": np.add.reduceat(volumes, starts),
+                "ticks": np.diff(np.append(starts, len(ids)))}
+
+        if self.partial is not None:
+            if self.partial["id"] == bars["id"][0]:
+                # the carried bar continues in this chunk
+                bars["open"][0] = self.partial["open"]
+                bars["high"][0] = max(bars["high"][0], self.partial["high"])
+                bars["low"][0] = min(bars["low"][0], self.partial["low"])
+                bars["volume"][0] += self.partial["volume"]
+                bars["ticks"][0] += self.partial["ticks"]
+            else:
+                bars = dict((name, np.concatenate(([self.partial[name]], values))) for name, values in bars.items())
+        self.partial = dict((name, values[-1]) for name, values in bars.items())
+        return Bars(*[bars[name][:-1] for name in Bars._fields])
+
+    def flush(self):
+        '''The carried bar, completed by the end of the stream (no bars if nothing is carried).'''
+        partial, self.partial = self.partial, None
+        if partial is None:
+            return _empty_bars("datetime64[s]")
+        return Bars(*[np.array([partial[name]]) for name in Bars._fields])
+
+    def _bar_ids(self, timestamps, volumes):
+        if self.kind == "time":
+            seconds = timestamps.astype("datetime64[s]").astype(np.int64)
+            return np.floor_divide(seconds, self.size).astype(np.int64)
+        if self.kind == "volume":
+            cumulative = self._volume + np.cumsum(volumes)
+            self._volume = cumulative[-1]
+            # bar k holds the ticks whose cumulative volume is in (k * size, (k + 1) * size]
+            return np.maximum(np.ceil(cumulative / self.size) - 1, 0).astype(np.int64)
+        counts = self._ticks + np.arange(len(volumes))
+        self._ticks += len(volumes)
+        return counts // int(self.size)
+
+
+def build_bars(chunks, kind, size):
+    '''Bars of every tick in chunks, an iterable of (timestamps, prices, volumes) such as TickSlices.'''
+    builder = BarBuilder(kind, size)
+    parts = [builder.update(*chunk) for chunk in chunks]
+    parts.append(builder.flush())
+    parts = [part for part in parts if len(part.close)]
+    if not parts:
+        return _empty_bars("datetime64[s]")
+    return Bars(*[np.concatenate([getattr(part, name) for part in parts]) for name in Bars._fields])
+
+
+def iter_csv_chunks(csv_path, chunksize=1000000):
+    '''TickSlices of a btce-style tick csv (epoch seconds, price, volume, no header), read chunk by chunk.'''
+    reader = pd.read_csv(csv_path, names=[name for name, _ in COLUMNS], chunksize=chunksize)
+    for chunk in reader:
+        yield TickSlice(chunk["timestamp"].values.astype(np.int64).view("datetime64[s]"),
+                        chunk["price"].values.astype(float), chunk["volume"].values.astype(float))
+
+
+def iter_store_chunks(store, start=None, end=None, chunksize=1000000):
+    '''TickSlices of a TickStore date range, chunksize rows at a time, as views into its memory maps.'''
+    first, last = store.row_range(start, end)
+    for row in range(first, last, chunksize):
+        stop = min(row + chunksize, last)
+        yield TickSlice(store.column("timestamp")[row:stop].view("datetime64[s]"),
+                        store.column("price")[row:stop], store.column("volume")[row:stop])
+
+
+def _empty_bars(dtype):
+    return Bars(np.empty(0, dtype=dtype), np.empty(0), np.empty(0), np.empty(0), np.empty(0), np.empty(0),
+                np.empty(0, dtype=int))
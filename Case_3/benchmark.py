@@ -0,0 +1,204 @@
+import argparse
+import gc
+import itertools
+import json
+import multiprocessing
+import sys
+import timeit
+import numpy as np
+import csv_items
+from TradeAnalysis import TradeAnalysis
+from autoregressive import backtest_autoregressive, lag_matrix
+from signal_expr import SignalGraph
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+PNL_SIZES = (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+TICK_SIZES = (10 ** 5, 10 ** 6)
+ENUMERATION_SIZES = (10 ** 4, 10 ** 5)
+EVALUATION_SIZES = (100, 1000)
+
+
+def synthetic_pnl(size, seed=0):
+    '''Daily P&L with a small positive drift, fat tails and about one flat day in five.'''
+    rng = np.random.RandomState(seed)
+    pnl = rng.standard_t(4, size) * 100 + 5
+    pnl[rng.rand(size) < 0.2] = 0
+    return pnl
+
+
+def synthetic_ticks(size, days=365, seed=0):
+    '''Tick timestamps (datetime64[s]) spread over the given number of days and a random-walk price.'''
+    rng = np.random.RandomState(seed)
+    start = np.datetime64('2015-01-01T00:00:00', 's').astype(np.int64)
+    offsets = np.sort(rng.randint(0, days * 86400, size))
+    prices = 250 * np.exp(np.cumsum(rng.randn(size) * 1e-3))
+    return (start + offsets).view('datetime64[s]'), prices
+
+
+def synthetic_panel(num_steps, num_tickers, seed=0):
+    '''Data mapping for SignalGraph.evaluate: positive random-walk factors and ticker fields.'''
+    rng = np.random.RandomState(seed)
+    data = dict((factor, np.exp(np.cumsum(rng.randn(num_steps)) * 0.02))
+                for factor in csv_items.FACTORS if factor != "1")
+    for field in csv_items.TICKERS:
+        data[field] = np.abs(rng.randn(num_steps, num_tickers)) + 0.1
+    return data
+
+
+def benchmark_cases(quick=False):
+    '''
+    (name, size, setup) triples; setup builds the inputs and returns the function that is timed, so
+    data generation is never part of a measurement.
+    '''
+    limit = 10 ** 5 if quick else None
+    cases = []
+    for size in PNL_SIZES:
+        cases.append(('get_stats', size, lambda size=size: _get_stats_case(size)))
+        cases.append(('calc_drawdown_list', size, lambda size=size: _drawdown_case(size)))
+    for size in TICK_SIZES:
+        cases.append(('backtest_autoregressive', size, lambda size=size: _backtest_case(size)))
+    for size in ENUMERATION_SIZES:
+        cases.append(('iter_ops', size, lambda size=size: _enumeration_case(size)))
+    for size in EVALUATION_SIZES:
+        cases.append(('evaluate_signals', size, lambda size=size: _evaluation_case(size)))
+    return [case for case in cases if limit is None or case[1] <= limit]
+
+
+def _get_stats_case(size):
+    pnl = synthetic_pnl(size)
+    returns = pnl / 1e6
+    # a new instance per run, so the stats cache is not what gets timed
+    return lambda: TradeAnalysis(pnl, returns).get_stats('P&L', 1e6)
+
+
+def _drawdown_case(size):
+    analysis = TradeAnalysis(synthetic_pnl(size), None)
+    return lambda: analysis.calc_drawdown_list('P&L', 1e6)
+
+
+def _backtest_case(size, look_back=5, percentile=0.75):
+    timestamps, prices = synthetic_ticks(size)
+    return lambda: backtest_autoregressive(timestamps[look_back:], lag_matrix(prices, look_back), look_back, percentile)
+
+
+def _enumeration_case(size):
+    signals = list(csv_items.iter_init())
+    return lambda: sum(1 for _ in itertools.islice(csv_items.iter_ops(signals), size))
+
+
+def _evaluation_case(size):
+    signals = list(itertools.islice(csv_items.iter_ops(list(csv_items.iter_init())), 0, size * 97, 97))
+    data = synthetic_panel(1000, 50)
+    return lambda: SignalGraph().add_all(signals).evaluate(data)
+
+
+def measure(run, repeat=3):
+    '''
+    Best wall time of repeat runs, and the peak memory of one run in MB: the peak traced by tracemalloc
+    or, without it (Python 2), the growth of the peak resident set size of a forked process making the
+    run. The two measure different things, so compare baselines from the same interpreter only.
+    '''
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        run()
+        seconds.append(timeit.default_timer() - start)
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            run()
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    else:
+        peak_mb = _peak_rss_mb(run)
+    return min(seconds), peak_mb
+
+
+def _peak_rss_mb(run):
+    # A forked process starts with its peak resident set at its current size rather than the parent's
+    # peak, so how far ru_maxrss grows over the run is the memory the run needed on top of its inputs.
+    if resource is None:
+        raise RuntimeError('measuring peak memory needs tracemalloc or the resource module')
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_report_rss_growth, args=(run, queue))
+    process.start()
+    growth = queue.get()
+    process.join()
+    if growth is None:
+        raise RuntimeError('the benchmark run failed in the memory measurement process')
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return growth * (1 if sys.platform == 'darwin' else 1024) / 1e6
+
+
+def _report_rss_growth(run, queue):
+    try:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        run()
+        queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+    except BaseException:
+        queue.put(None)
+        raise
+
+
+def run_benchmarks(cases, repeat=3, stream=sys.stdout):
+    results = {}
+    for name, size, setup in cases:
+        seconds, peak_mb = measure(setup(), repeat)
+        key = '{}/{}'.format(name, size)
+        results[key] = {'seconds': seconds, 'peak_mb': peak_mb}
+        stream.write('{:<36}{:>12.4f} s{:>12.1f} MB\n'.format(key, seconds, peak_mb))
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    '''Cases whose time or peak memory is more than threshold (a fraction) above the baseline.'''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        for metric in ('seconds', 'peak_mb'):
+            old, new = baseline[key].get(metric), results[key][metric]
+            if old and new > old * (1 + threshold):
+                regressions.append((key, metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time TradeAnalysis, the backtester and signal generation.')
+    parser.add_argument('--baseline', help='JSON baseline to compare against')
+    parser.add_argument('--save-baseline', help='write the results as a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown as a fraction')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='only sizes up to 10^5')
+    parser.add_argument('--only', help='run only the cases whose name contains this string')
+    args = parser.parse_args(argv)
+
+    cases = [case for case in benchmark_cases(args.quick) if args.only is None or args.only in case[0]]
+    results = run_benchmarks(cases, args.repeat)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for key, metric, old, new in regressions:
+            print('REGRESSION {} {}: {:.4g} -> {:.4g}'.format(key, metric, old, new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
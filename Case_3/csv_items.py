@@ -45,6 +45,7 @@ def build_init(signals):
 
 def build_ops(signals):
 	# do operations
+	# (a nested loop rather than iter_ops, which needs distinct signals: this skips equal pairs instead)
 	temp_list = []
 	for e, factor1 in enumerate(signals):
 		for i, factor2 in enumerate(signals):
@@ -60,16 +61,145 @@ def build_ops(signals):
 
 def build_fun(signals):
 	# do funstuff
-	temp_list = []
-	for factor in signals:
-		for fun in FUNSTUFF:
-			str1 = fun + "({})".format(factor)
-			temp_list.append(str1)
+	temp_list = list(iter_fun(signals))
 	for str1 in temp_list:
 		signals.append(str1)
 		print(str1)		
 
 
+# Lazy enumeration of the candidates build_init/build_ops/build_fun produce, in the same order.
+# The Nth candidate can be computed directly, so the search space can be split into index ranges
+# (see chunk_range) and handed to worker processes without materializing the lists.
+
+COMMUTATIVE = ("+", "*")
+NONCOMMUTATIVE = tuple(op for op in OPERATIONS if op not in COMMUTATIVE)
+
+
+def base_signals():
+	# the time-delayed factors and ticker fields build_init starts from
+	base = []
+	for factor in FACTORS:
+		if factor == "1":
+			base.append(factor)
+		else:
+			for delay in range(1, MAX_DELAY + 1):
+				base.append(factor + "_{" + "t-{}".format(delay) + "}")
+	for factor in TICKERS:
+		for delay in range(1, MAX_DELAY + 1):
+			base.append(factor + "_{" + "t-{}".format(delay) + "}")
+	return base
+
+
+BASE_SIGNALS = tuple(base_signals())
+
+
+def count_init():
+	return len(BASE_SIGNALS) * (1 + len(CHANGERS))
+
+
+def nth_init(n):
+	if n < len(BASE_SIGNALS):
+		return BASE_SIGNALS[n]
+	n -= len(BASE_SIGNALS)
+	return CHANGERS[n % len(CHANGERS)] + "({})".format(BASE_SIGNALS[n // len(CHANGERS)])
+
+
+def iter_init(start=0, stop=None):
+	stop = count_init() if stop is None else min(stop, count_init())
+	# a counter rather than range, which would build the whole index list under Python 2
+	n = start
+	while n < stop:
+		yield nth_init(n)
+		n += 1
+
+
+def count_ops(signals):
+	# every ordered pair of different signals, with + and * only once per unordered pair
+	n = len(signals)
+	return len(OPERATIONS) * n * (n - 1) - len(COMMUTATIVE) * n * (n - 1) // 2
+
+
+def _ops_before_row(n, e):
+	# candidates generated for factor1 = signals[0 .. e-1]; row e has 3e + 5(n-1-e) of them
+	return len(OPERATIONS) * (n - 1) * e - len(COMMUTATIVE) * e * (e - 1) // 2
+
+
+def _locate_op(n, index):
+	# (e, i, k): the index-th candidate is signals[e] op signals[i], op the k-th allowed operation
+	low, high = 0, n - 1
+	while low < high:
+		middle = (low + high + 1) // 2
+		if _ops_before_row(n, middle) <= index:
+			low = middle
+		else:
+			high = middle - 1
+	e = low
+	offset = index - _ops_before_row(n, e)
+	if offset < len(NONCOMMUTATIVE) * e:
+		return e, offset // len(NONCOMMUTATIVE), offset % len(NONCOMMUTATIVE)
+	offset -= len(NONCOMMUTATIVE) * e
+	return e, e + 1 + offset // len(OPERATIONS), offset % len(OPERATIONS)
+
+
+def _check_unique(signals):
+	if len(set(signals)) != len(signals):
+		raise ValueError("signals must be distinct to be enumerated by index")
+
+
+def nth_op(signals, index):
+	# signals must be distinct, as iter_ops checks; that is not repeated here, for cheap single lookups
+	if not 0 <= index < count_ops(signals):
+		raise IndexError("candidate index out of range")
+	e, i, k = _locate_op(len(signals), index)
+	ops = OPERATIONS if i > e else NONCOMMUTATIVE
+	return "(" + signals[e] + ops[k] + signals[i] + ")"
+
+
+def iter_ops(signals, start=0, stop=None):
+	_check_unique(signals)
+	n = len(signals)
+	total = count_ops(signals)
+	stop = total if stop is None else min(stop, total)
+	if start >= stop:
+		return
+	e, i, k = _locate_op(n, start)
+	index = start
+	while index < stop:
+		ops = OPERATIONS if i > e else NONCOMMUTATIVE
+		yield "(" + signals[e] + ops[k] + signals[i] + ")"
+		index += 1
+		k += 1
+		if k == len(ops):
+			k = 0
+			i += 1
+			if i == e:
+				i += 1
+			if i == n:
+				e += 1
+				i = 0
+
+
+def count_fun(signals):
+	return len(signals) * len(FUNSTUFF)
+
+
+def nth_fun(signals, index):
+	return FUNSTUFF[index % len(FUNSTUFF)] + "({})".format(signals[index // len(FUNSTUFF)])
+
+
+def iter_fun(signals, start=0, stop=None):
+	stop = count_fun(signals) if stop is None else min(stop, count_fun(signals))
+	index = start
+	while index < stop:
+		yield nth_fun(signals, index)
+		index += 1
+
+
+def chunk_range(total, num_chunks, chunk):
+	# [start, stop) of the chunk-th of num_chunks near-equal slices of range(total)
+	return total * chunk // num_chunks, total * (chunk + 1) // num_chunks
+
+
 if __name__ == "__main__":
 	signals = []
 	build_init(signals)
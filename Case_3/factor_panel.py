@@ -0,0 +1,124 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from csv_items import MAX_DELAY
+
+TICKER_FIELDS = ("market_cap", "pb", "returns")
+
+
+def build_panel(factors, info, store_dir):
+    '''
+    Writes the factor frame (one row per timestep) and the ticker data frame (one row per ticker and
+    timestep) into one panel: a (T, F) factor matrix indexed by timestep, stored once, and a (T, N)
+    array per ticker field, with NaN where a ticker has no row. industry is stored as int8 codes
+    (-1 for missing) into the category list kept in meta.json.
+    '''
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    factor_names = [column for column in factors.columns if column != "timestep"]
+    timesteps = np.union1d(factors["timestep"].values, info["timestep"].values)
+    tickers = np.unique(info["ticker"].values)
+    if tickers.dtype == object:
+        # fixed-width strings, so the labels can be memory-mapped like the rest
+        tickers = tickers.astype(str)
+
+    factor_matrix = np.full((len(timesteps), len(factor_names)), np.nan)
+    factor_matrix[np.searchsorted(timesteps, factors["timestep"].values)] = factors[factor_names].values
+    np.save(os.path.join(store_dir, "timesteps.npy"), timesteps)
+    np.save(os.path.join(store_dir, "tickers.npy"), tickers)
+    np.save(os.path.join(store_dir, "factors.npy"), factor_matrix)
+
+    rows = np.searchsorted(timesteps, info["timestep"].values)
+    columns = np.searchsorted(tickers, info["ticker"].values)
+    for name in TICKER_FIELDS:
+        field = np.full((len(timesteps), len(tickers)), np.nan)
+        field[rows, columns] = info[name].values
+        np.save(os.path.join(store_dir, name + ".npy"), field)
+    industries = []
+    if "industry" in info.columns:
+        codes, industries = pd.factorize(info["industry"])
+        field = np.full((len(timesteps), len(tickers)), -1, dtype=np.int8)
+        field[rows, columns] = codes
+        np.save(os.path.join(store_dir, "industry.npy"), field)
+        industries = [str(industry) for industry in industries]
+
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump({"factors": factor_names, "industries": industries}, f)
+    return FactorPanel(store_dir)
+
+
+class FactorPanel:
+    '''
+    Read side of a panel written by build_panel. Arrays are memory-mapped on first use, so worker
+    processes that open the same store share its pages instead of each holding a copy, and a
+    FactorPanel pickles as its directory only: passing one to a pool worker reopens the maps there.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.factor_names = meta["factors"]
+        self.industries = meta["industries"]
+        self._arrays = {}
+
+    def __getstate__(self):
+        return {"store_dir": self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["store_dir"])
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.store_dir, name + ".npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    @property
+    def timesteps(self):
+        return self.array("timesteps")
+
+    @property
+    def tickers(self):
+        return self.array("tickers")
+
+    @property
+    def factors(self):
+        return self.array("factors")
+
+    def factor(self, name):
+        return self.factors[:, self.factor_names.index(name)]
+
+    def field(self, name):
+        return self.array(name)
+
+    def rows(self, timesteps):
+        '''Panel rows of the given timesteps, -1 where the panel has no such timestep.'''
+        rows = np.searchsorted(self.timesteps, timesteps)
+        rows = np.minimum(rows, len(self.timesteps) - 1)
+        return np.where(self.timesteps[rows] == timesteps, rows, -1)
+
+    def lags(self, values, max_delay=MAX_DELAY):
+        '''
+        Zero-copy view of values with the lags along a new axis 1: [r, k] is values[max_delay + r - k],
+        the _{t-k} value for row t = max_delay + r. Works for factor columns, the factor matrix and
+        ticker fields alike.
+        '''
+        stride = values.strides[0]
+        return np.lib.stride_tricks.as_strided(values[max_delay:],
+                                               shape=(len(values) - max_delay, max_delay + 1) + values.shape[1:],
+                                               strides=(stride, -stride) + values.strides[1:], writeable=False)
+
+    def data(self, tickers=slice(None)):
+        '''
+        Mapping of factor and ticker field names to arrays in the layout SignalGraph.evaluate takes:
+        (T,) factor columns and (T, N) ticker fields, views for a slice of tickers. industry codes
+        are returned as floats with NaN for missing.
+        '''
+        data = dict((name, self.factor(name)) for name in self.factor_names)
+        for name in TICKER_FIELDS:
+            data[name] = self.field(name)[:, tickers]
+        if self.industries:
+            codes = self.field("industry")[:, tickers]
+            data["industry"] = np.where(codes >= 0, codes, np.nan)
+        return data
@@ -0,0 +1,135 @@
+import itertools
+import warnings
+import numpy as np
+from scipy import sparse
+from signal_expr import SignalGraph
+
+# share of a block that may be degenerate before screen_features warns about it
+DEGENERATE_WARNING_SHARE = 0.5
+
+
+def screen_features(signals, panels, threshold=0.95, max_features=None, block_size=256, sketch_size=4096,
+                    seed=0):
+    '''
+    Greedy numerical screening of candidate signals, run after the symbolic dedupe: in candidate order,
+    a signal is kept unless its absolute correlation with an already kept signal, pooled over every
+    row of the panel, is at least threshold. Signals that are constant or undefined everywhere are
+    dropped as degenerate, with a warning when they make up more than DEGENERATE_WARNING_SHARE of a
+    block, and screening stops once max_features signals have been kept.
+
+    panels is a re-iterable sequence of data mappings as accepted by SignalGraph.evaluate (e.g. groups
+    of tickers from ticker_chunks), or a single mapping. Candidates are evaluated block_size at a
+    time, one panel chunk at a time, and each feature is reduced to a sketch_size-long CountSketch
+    of its centred column (rows hashed to buckets with random signs), so memory is bounded by the
+    block and the kept sketches rather than the panel. Sketched correlations are accurate to about
+    1 / sqrt(sketch_size); pass sketch_size=None to keep full columns and screen exactly.
+
+    Returns the kept signals and a report of how many candidates were eliminated and why.
+    '''
+    if isinstance(panels, dict):
+        panels = [panels]
+    signals = iter(signals)
+    kept = []
+    kept_embeddings = None
+    report = {"candidates": 0, "kept": 0, "eliminated": 0, "near_duplicates": 0, "degenerate": 0,
+              "not_screened": 0}
+    while max_features is None or len(kept) < max_features:
+        block = list(itertools.islice(signals, block_size))
+        if not block:
+            break
+        report["candidates"] += len(block)
+        embeddings = _embed_block(block, panels, sketch_size, seed)
+        valid = np.isfinite(embeddings).all(axis=1) & (np.abs(embeddings).sum(axis=1) > 0)
+        report["degenerate"] += int(np.sum(~valid))
+        if np.mean(~valid) > DEGENERATE_WARNING_SHARE:
+            # usually a data or evaluation problem (e.g. too few rows for the rolling functions)
+            # rather than genuinely constant candidates
+            warnings.warn("{} of {} candidates starting at {!r} are constant or undefined everywhere"
+                          .format(int(np.sum(~valid)), len(block), block[0]), RuntimeWarning)
+
+        # correlations with the kept signals, then greedily within the block
+        if kept_embeddings is None:
+            duplicate = np.zeros(len(block), dtype=bool)
+        else:
+            duplicate = (np.abs(embeddings.dot(kept_embeddings.T)) >= threshold).any(axis=1)
+        within = np.abs(embeddings.dot(embeddings.T)) >= threshold
+        accepted = []
+        for i in np.flatnonzero(valid):
+            if max_features is not None and len(kept) + len(accepted) >= max_features:
+                report["not_screened"] += int(np.sum(valid[i:]))
+                break
+            if duplicate[i] or within[i, accepted].any():
+                report["near_duplicates"] += 1
+                continue
+            accepted.append(i)
+        kept.extend(block[i] for i in accepted)
+        kept_embeddings = embeddings[accepted] if kept_embeddings is None else \
+            np.concatenate((kept_embeddings, embeddings[accepted]))
+
+    rest = sum(1 for _ in signals)
+    report["candidates"] += rest
+    report["not_screened"] += rest
+    report["kept"] = len(kept)
+    report["eliminated"] = report["candidates"] - report["kept"]
+    return kept, report
+
+
+def ticker_chunks(data, tickers_per_chunk):
+    '''
+    Splits a (T, N) panel mapping into mappings of at most tickers_per_chunk tickers each, as views.
+    Factor fields of shape (T,) are shared by every chunk.
+    '''
+    num_tickers = max(np.shape(values)[1] for values in data.values() if np.ndim(values) == 2)
+    return [dict((name, values[:, start:start + tickers_per_chunk] if np.ndim(values) == 2 else values)
+                 for name, values in data.items())
+            for start in range(0, num_tickers, tickers_per_chunk)]
+
+
+def _embed_block(block, panels, sketch_size, seed):
+    # Unit-norm embeddings whose dot products are the pooled correlations of the block's signals.
+    # Missing values are mean-filled, i.e. they add nothing to the centred column: with m the mask of
+    # finite rows, sketch(centred x) = sketch(x * m) - mean * sketch(m).
+    graph = SignalGraph().add_all(block)
+    count = np.zeros(len(block))
+    total = np.zeros(len(block))
+    squares = np.zeros(len(block))
+    sketch_values = []
+    sketch_mask = []
+    for chunk_index, data in enumerate(panels):
+        values = graph.evaluate(data)
+        values = values.reshape(-1, len(block))
+        finite = np.isfinite(values)
+        values = np.where(finite, values, 0)
+        count += finite.sum(axis=0)
+        total += values.sum(axis=0)
+        squares += np.einsum('ij,ij->j', values, values)
+        if sketch_size is None:
+            sketch_values.append(values)
+            sketch_mask.append(finite)
+        else:
+            projection = _count_sketch(len(values), sketch_size, seed, chunk_index)
+            sketch_values.append(projection.dot(values))
+            sketch_mask.append(projection.dot(finite.astype(float)))
+    if sketch_size is None:
+        sketch_values, sketch_mask = np.concatenate(sketch_values), np.concatenate(sketch_mask)
+    else:
+        sketch_values, sketch_mask = np.sum(sketch_values, axis=0), np.sum(sketch_mask, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        norm = np.sqrt(np.maximum(squares - count * mean ** 2, 0))
+        embeddings = sketch_values - mean * sketch_mask
+        # normalising by the sketched rather than the exact norm makes the errors in the numerator and
+        # denominator of each correlation largely cancel
+        embeddings /= np.linalg.norm(embeddings, axis=0)
+    # tiny relative variance is rounding noise on a constant column
+    embeddings[:, ~(norm > 1e-12 * np.sqrt(squares))] = np.nan
+    return embeddings.T
+
+
+def _count_sketch(num_rows, sketch_size, seed, chunk_index):
+    # seeded by chunk so that every block hashes the same panel rows the same way
+    rng = np.random.RandomState([seed, chunk_index])
+    buckets = rng.randint(sketch_size, size=num_rows)
+    signs = rng.randint(2, size=num_rows) * 2.0 - 1
+    return sparse.csr_matrix((signs, (buckets, np.arange(num_rows))), shape=(sketch_size, num_rows))
@@ -0,0 +1,162 @@
+import functools
+import json
+import os
+import timeit
+import pandas as pd
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+SUMMARY_COLUMNS = ['calls', 'seconds', 'mean_seconds', 'share', 'rows', 'memory_delta_mb']
+
+
+class Profiler:
+    '''
+    Opt-in timing of the stages of a run. Each stage is a with block (or a function wrapped by timed)
+    and produces one record: its name, prefixed by the enclosing stages ("backtest/fit"), wall time,
+    an optional row count, any extra fields given (e.g. the month) and, with track_memory, the change
+    in memory traced by tracemalloc or, without it (Python 2), in the resident set size read from
+    /proc/self/statm. Records are written to stream as JSON lines as they finish and summary
+    aggregates them per stage. Code that takes a profiler defaults to NULL_PROFILER, which does
+    nothing.
+    '''
+
+    def __init__(self, stream=None, track_memory=False):
+        self.stream = stream
+        self.track_memory = track_memory
+        self.records = []
+        self._stack = []
+        self._started_tracing = False
+        self._memory = None
+        if track_memory:
+            if tracemalloc is not None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracing = True
+                self._memory = _traced_bytes
+            elif os.path.exists('/proc/self/statm'):
+                self._memory = _resident_bytes
+            else:
+                raise RuntimeError('track_memory needs tracemalloc or /proc/self/statm')
+
+    def stage(self, name, rows=None, **fields):
+        '''
+        Context manager timing the enclosed block. It returns the stage's record, so the block can
+        fill in rows or other fields it only knows at the end.
+        '''
+        return _Stage(self, name, rows, fields)
+
+    def timed(self, name=None):
+        '''Decorator timing every call of a function as a stage, by default named after the function.'''
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def summary(self):
+        '''
+        Calls, total and mean seconds, share of the time of the outermost stages, rows and memory
+        change per stage, slowest first.
+        '''
+        if not self.records:
+            return pd.DataFrame([], columns=SUMMARY_COLUMNS)
+        records = pd.DataFrame(self.records)
+        for column in ('rows', 'memory_delta_mb'):
+            if column not in records:
+                records[column] = float('nan')
+        grouped = records.groupby('stage')
+        summary = pd.DataFrame({'calls': grouped.size(),
+                                'seconds': grouped['seconds'].sum(),
+                                'rows': grouped['rows'].sum(min_count=1),
+                                'memory_delta_mb': grouped['memory_delta_mb'].sum(min_count=1)})
+        summary['mean_seconds'] = summary['seconds'] / summary['calls']
+        total = records.loc[~records['stage'].str.contains('/'), 'seconds'].sum()
+        summary['share'] = summary['seconds'] / total if total else float('nan')
+        return summary[SUMMARY_COLUMNS].sort_values('seconds', ascending=False)
+
+    def print_summary(self):
+        print(self.summary().to_string())
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+
+class _Stage:
+
+    def __init__(self, profiler, name, rows, fields):
+        self.profiler = profiler
+        self.record = dict(fields)
+        self.record['stage'] = '/'.join(profiler._stack + [name])
+        self.record['rows'] = rows
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._stack.append(self.name)
+        self.memory = self.profiler._memory() if self.profiler.track_memory else None
+        self.start = timeit.default_timer()
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['seconds'] = timeit.default_timer() - self.start
+        if self.memory is not None:
+            self.record['memory_delta_mb'] = (self.profiler._memory() - self.memory) / 1e6
+        self.profiler._stack.pop()
+        self.profiler.records.append(self.record)
+        if self.profiler.stream is not None:
+            self.profiler.stream.write(json.dumps(self.record, default=_json_default) + '\n')
+        return False
+
+
+class NullProfiler:
+    '''Profiler that records nothing: stage hands back one shared no-op context manager.'''
+
+    def stage(self, name, rows=None, **fields):
+        return _NULL_STAGE
+
+    def timed(self, name=None):
+        return lambda function: function
+
+    def summary(self):
+        return pd.DataFrame([], columns=SUMMARY_COLUMNS)
+
+    def print_summary(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _NullStage:
+
+    def __enter__(self):
+        # a scratch record, so blocks can fill in fields whether or not they are profiled
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def _traced_bytes():
+    return tracemalloc.get_traced_memory()[0]
+
+
+def _resident_bytes():
+    # the second field of statm is the number of resident pages
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _json_default(value):
+    # numpy scalars (row counts from len or array sizes) as plain numbers, anything else as text
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+_NULL_STAGE = _NullStage()
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,352 @@
+import multiprocessing as mp
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import Lasso
+from csv_items import MAX_DELAY
+from factor_panel import FactorPanel
+
+INFO_COLUMNS = ['returns', 'ticker', 'timestep', 'pb', 'market_cap']
+TRAIN_END = 1050
+DFMAX = 10
+
+
+def load_inputs(factor_path, signal_path, info_path):
+    '''Reads the three inputs of the model picker, each exactly once.'''
+    factors = pd.read_csv(factor_path)
+    signals = pd.read_csv(signal_path)
+    signals = signals.drop(columns=[column for column in ['delete'] if column in signals.columns])
+    info = pd.read_csv(info_path, usecols=INFO_COLUMNS)
+    return factors, signals, info
+
+
+def merge_inputs(signals, info, train_end=TRAIN_END):
+    '''
+    The ticker part of the training frame of every ticker at once: one merge of the ticker data with
+    the ticker signals instead of a subset and merge per ticker, limited to timesteps before
+    train_end (the rest is kept for validation), sorted by ticker and timestep. Factor signals are
+    not merged in, so the factor block is never repeated per ticker.
+    '''
+    merged = info.merge(signals, on=[column for column in signals.columns if column in info.columns])
+    merged = merged[merged['timestep'] < train_end]
+    merged = merged.drop(columns=[column for column in ['index'] if column in merged.columns])
+    return merged.sort_values(['ticker', 'timestep'], kind='mergesort').reset_index(drop=True)
+
+
+def fit_lasso_path(X, y, dfmax=DFMAX, num_alphas=100, alpha_min_ratio=None, warm_start=True):
+    '''
+    glmnet-style lasso: features are standardized (population sd), the penalty runs down a log-spaced
+    path from the smallest alpha that zeroes every coefficient, and the path stops before the first
+    fit with more than dfmax nonzero coefficients. With warm_start each fit on the path starts from
+    the previous solution. Returns the intercept, the coefficients on the original feature scale and
+    the alpha of the last fit kept.
+    '''
+    num_obs, num_features = X.shape
+    mean_x = X.mean(axis=0)
+    scale_x = X.std(axis=0)
+    usable = scale_x > 0
+    Z = (X[:, usable] - mean_x[usable]) / scale_x[usable]
+    centered_y = y - y.mean()
+
+    alpha_max = np.max(np.abs(Z.T.dot(centered_y))) / num_obs if Z.shape[1] else 0
+    if alpha_min_ratio is None:
+        alpha_min_ratio = 1e-4 if num_obs > num_features else 1e-2
+    alphas = alpha_max * np.logspace(0, np.log10(alpha_min_ratio), num_alphas)
+
+    best = np.zeros(Z.shape[1])
+    best_alpha = alpha_max
+    if alpha_max > 0:
+        model = Lasso(alpha=alpha_max, fit_intercept=False, warm_start=warm_start)
+        for alpha in alphas:
+            model.set_params(alpha=alpha)
+            model.fit(Z, centered_y)
+            if np.count_nonzero(model.coef_) > dfmax:
+                break
+            best = model.coef_.copy()
+            best_alpha = alpha
+
+    coef = np.zeros(num_features)
+    coef[usable] = best / scale_x[usable]
+    return y.mean() - coef.dot(mean_x), coef, best_alpha
+
+
+def gram_lasso_path(gram, corr, alphas, dfmax=None, tol=1e-7, max_sweeps=1000):
+    '''
+    Lasso path by coordinate descent on the Gram matrix of standardized features: for each alpha in
+    turn, warm-started from the previous one, minimises b'Gb / 2 - c'b + alpha * |b|_1, which is the
+    objective of fit_lasso_path with G = Z'Z / n and c = Z'y / n. Nothing here depends on the number
+    of observations. Coordinate descent only cycles over the active set (every feature that has been
+    nonzero); the optimality conditions of the other features are then checked all at once and any
+    that would move join the set. With dfmax the path stops before the first fit with more than dfmax
+    nonzero coefficients. Returns the coefficients as an (alphas reached, features) array.
+    '''
+    num_features = len(corr)
+    coefs = []
+    coef = np.zeros(num_features)
+    fitted = np.zeros(num_features)
+    diagonal = np.diag(gram)
+    tol = tol * max(np.max(np.abs(corr)), 1e-300) if num_features else tol
+    active = []
+    inactive = np.ones(num_features, dtype=bool)
+    for alpha in alphas:
+        for _ in range(max_sweeps):
+            for _ in range(max_sweeps):
+                max_change = 0
+                for j in active:
+                    residual = corr[j] - fitted[j] + diagonal[j] * coef[j]
+                    new = np.sign(residual) * max(abs(residual) - alpha, 0) / diagonal[j]
+                    if new != coef[j]:
+                        fitted += gram[:, j] * (new - coef[j])
+                        max_change = max(max_change, abs(new - coef[j]))
+                        coef[j] = new
+                if max_change < tol:
+                    break
+            # a zero coefficient moves exactly when its residual correlation exceeds alpha
+            violators = np.flatnonzero(inactive & (np.abs(corr - fitted) > alpha))
+            if not len(violators):
+                break
+            active.extend(violators.tolist())
+            inactive[violators] = False
+        if dfmax is not None and np.count_nonzero(coef) > dfmax:
+            break
+        coefs.append(coef.copy())
+    return np.array(coefs).reshape(len(coefs), num_features)
+
+
+def walk_forward_folds(timesteps, num_folds=5, purge=MAX_DELAY, embargo=0):
+    '''
+    Expanding-window walk-forward splits: the distinct timesteps are cut into num_folds + 1 blocks and
+    fold k validates on block k + 1, training on the timesteps before it less the last purge of
+    them, whose lagged features overlap the validation block. The first embargo timesteps of each
+    validation block are skipped too. Returns a (train mask, validation mask) pair per fold.
+    '''
+    distinct = np.unique(timesteps)
+    bounds = np.linspace(0, len(distinct), num_folds + 2).astype(int)
+    folds = []
+    for k in range(1, num_folds + 1):
+        start = distinct[bounds[k]] if bounds[k] < len(distinct) else np.inf
+        end = distinct[bounds[k + 1]] if bounds[k + 1] < len(distinct) else np.inf
+        folds.append((timesteps < start - purge, (timesteps >= start + embargo) & (timesteps < end)))
+    return folds
+
+
+def pick_models(factors, signals, info, tickers=None, processes=None, train_end=TRAIN_END, **kwargs):
+    '''
+    Fits the lasso of every ticker (or of the given tickers) over a process pool. factors is the
+    factor frame or a FactorPanel holding it; workers join each ticker's rows to the factor matrix
+    by timestep, and a panel's matrix is memory-mapped by every worker rather than copied to each.
+    Rows with a missing value are dropped per ticker, as na.omit did. Keyword arguments go to
+    fit_lasso_path. Returns one frame indexed by ticker with the intercept, a coefficient per
+    feature, the alpha of the chosen fit ("lambda"), its number of nonzero coefficients ("df") and
+    the number of observations.
+    '''
+    features, labels, ranges, initargs = _prepare_tickers(factors, signals, info, tickers, train_end)
+    pool = mp.Pool(processes, initializer=_init_picker_worker, initargs=initargs + (kwargs,))
+    try:
+        results = pool.map(_run_picker_task, ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+    columns = ['(Intercept)'] + features + ['lambda', 'df', 'num_obs']
+    index = pd.Index(labels, name='ticker')
+    return pd.DataFrame([list(row) for row in results], index=index, columns=columns)
+
+
+def cross_validate_models(factors, signals, info, tickers=None, processes=None, train_end=TRAIN_END,
+                          feature_subsets=None, num_folds=5, purge=MAX_DELAY, embargo=0, dfmax=DFMAX,
+                          num_alphas=100, alpha_min_ratio=None):
+    '''
+    Chooses each ticker's lasso penalty by purged walk-forward cross-validation (walk_forward_folds)
+    on the rows before train_end, instead of taking the end of the glmnet path. Work runs on a process
+    pool in two rounds. First each ticker's full training rows are reduced once to their moments and
+    fix, per feature subset, a glmnet-style alpha grid cut before the first alpha whose full fit has
+    more than dfmax nonzero coefficients. Then every (ticker, fold) pair is a task that reduces its
+    rows once to sufficient statistics (counts, sums, X'X, X'y, y'y) for the training and validation
+    sets. The Gram matrix is reused for every alpha on the grid (gram_lasso_path) and for every
+    candidate subset, and validation errors are computed from the validation moments without forming
+    predictions.
+
+    Fold paths stop at dfmax as well, so, as in cv.glmnet, an alpha is only scored if every fold
+    reaches it. feature_subsets maps a name to a list of feature names and defaults to all features.
+    Returns a frame indexed by ticker and subset with the alpha with the best pooled out-of-sample R^2
+    ("lambda"), that R^2, and the df of the full fit.
+    '''
+    features, labels, ranges, initargs = _prepare_tickers(factors, signals, info, tickers, train_end)
+    if feature_subsets is None:
+        feature_subsets = {'all': features}
+    subsets = [(name, np.array([features.index(feature) for feature in subset], dtype=int))
+               for name, subset in sorted(feature_subsets.items())]
+    options = {'subsets': subsets, 'num_folds': num_folds, 'purge': purge, 'embargo': embargo, 'dfmax': dfmax,
+               'num_alphas': num_alphas, 'alpha_min_ratio': alpha_min_ratio}
+    pool = mp.Pool(processes, initializer=_init_picker_worker, initargs=initargs + (options,))
+    try:
+        grids = pool.map(_run_grid_task, ranges)
+        tasks = [(rows, fold, grid) for rows, grid in zip(ranges, grids) if grid is not None
+                 for fold in range(num_folds)]
+        results = iter(pool.map(_run_cv_task, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+    table = []
+    for label, grid in zip(labels, grids):
+        folds = [] if grid is None else [fold for fold in [next(results) for _ in range(num_folds)]
+                                         if fold is not None]
+        for name, _ in subsets:
+            if not folds:
+                table.append((label, name, np.nan, np.nan, 0))
+                continue
+            alphas, df = grid[name]
+            sse = np.sum([fold[name][0] for fold in folds], axis=0)
+            sst = np.sum([fold[name][1] for fold in folds])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                oos_r2 = 1 - sse / sst
+            if np.all(np.isnan(oos_r2)):
+                table.append((label, name, np.nan, np.nan, 0))
+                continue
+            best = np.nanargmax(oos_r2)
+            table.append((label, name, alphas[best], oos_r2[best], df[best]))
+    frame = pd.DataFrame(table, columns=['ticker', 'subset', 'lambda', 'oos_r2', 'df'])
+    return frame.set_index(['ticker', 'subset'])
+
+
+def _prepare_tickers(factors, signals, info, tickers, train_end):
+    merged = merge_inputs(signals, info, train_end)
+    if tickers is not None:
+        merged = merged[merged['ticker'].isin(tickers)].reset_index(drop=True)
+    ticker_features = [column for column in merged.columns if column not in ('returns', 'ticker', 'timestep')]
+    if isinstance(factors, FactorPanel):
+        factor_names = factors.factor_names
+        factor_source = factors
+    else:
+        factor_names = [column for column in factors.columns if column != 'timestep']
+        factor_source = (factors['timestep'].values, np.asarray(factors[factor_names].values, dtype=float))
+
+    # rows are sorted by ticker, so each ticker is one contiguous block
+    ticker_values = merged['ticker'].values
+    starts = np.flatnonzero(np.concatenate(([True], ticker_values[1:] != ticker_values[:-1])))
+    stops = np.append(starts[1:], len(merged))
+    initargs = (np.asfortranarray(merged[ticker_features].values, dtype=float),
+                merged['returns'].values.astype(float), merged['timestep'].values, factor_source)
+    return ticker_features + list(factor_names), ticker_values[starts], list(zip(starts, stops)), initargs
+
+
+_PICKER_DATA = {}
+
+
+def _init_picker_worker(X, y, timesteps, factor_source, kwargs):
+    if isinstance(factor_source, FactorPanel):
+        factor_source = (factor_source.timesteps, factor_source.factors)
+    _PICKER_DATA['X'] = X
+    _PICKER_DATA['y'] = y
+    _PICKER_DATA['timesteps'] = timesteps
+    _PICKER_DATA['factor_timesteps'], _PICKER_DATA['factors'] = factor_source
+    _PICKER_DATA['kwargs'] = kwargs
+
+
+def _ticker_arrays(rows):
+    # the ticker's rows joined to the factor matrix by timestep, less rows with a missing value
+    timesteps = _PICKER_DATA['timesteps'][rows[0]:rows[1]]
+    factor_timesteps = _PICKER_DATA['factor_timesteps']
+    factor_rows = np.minimum(np.searchsorted(factor_timesteps, timesteps), len(factor_timesteps) - 1)
+    matched = factor_timesteps[factor_rows] == timesteps
+    X = np.hstack((_PICKER_DATA['X'][rows[0]:rows[1]][matched], _PICKER_DATA['factors'][factor_rows[matched]]))
+    y = _PICKER_DATA['y'][rows[0]:rows[1]][matched]
+    complete = np.isfinite(X).all(axis=1) & np.isfinite(y)
+    return X[complete], y[complete], timesteps[matched][complete]
+
+
+def _run_picker_task(rows):
+    X, y, _ = _ticker_arrays(rows)
+    if not len(y):
+        return [np.nan] * (X.shape[1] + 3) + [0]
+    intercept, coef, alpha = fit_lasso_path(X, y, **_PICKER_DATA['kwargs'])
+    return [intercept] + list(coef) + [alpha, np.count_nonzero(coef), len(y)]
+
+
+def _cv_arrays(rows):
+    # a common shift of every row leaves fits and errors unchanged and keeps the moments well conditioned
+    X, y, timesteps = _ticker_arrays(rows)
+    return X - X.mean(axis=0), y - y.mean(), timesteps
+
+
+def _run_grid_task(rows):
+    # per subset, the alpha grid of the full training rows, cut before the first alpha whose fit has
+    # more than dfmax nonzero coefficients, and the df of each alpha kept
+    options = _PICKER_DATA['kwargs']
+    X, y, _ = _cv_arrays(rows)
+    if len(y) < 2:
+        return None
+    full = _moments(X, y)
+    grids = {}
+    for name, columns in options['subsets']:
+        gram, corr, _, _ = _standardize(full, columns)
+        alpha_max = np.max(np.abs(corr)) if len(corr) else 0
+        ratio = options['alpha_min_ratio']
+        if ratio is None:
+            ratio = 1e-4 if full[0] > len(columns) else 1e-2
+        alphas = alpha_max * np.logspace(0, np.log10(ratio), options['num_alphas'])
+        path = gram_lasso_path(gram, corr, alphas, options['dfmax'])
+        grids[name] = (alphas[:len(path)], np.count_nonzero(path, axis=1))
+    return grids
+
+
+def _run_cv_task(task):
+    # per subset, the validation SSE of the fold's fit at each alpha of the grid (nan past the first
+    # alpha with more than dfmax nonzero coefficients) and the validation SST
+    rows, fold, grids = task
+    options = _PICKER_DATA['kwargs']
+    X, y, timesteps = _cv_arrays(rows)
+    train, validation = walk_forward_folds(timesteps, options['num_folds'], options['purge'],
+                                           options['embargo'])[fold]
+    if train.sum() < 2 or not validation.any():
+        return None
+    train, validation = _moments(X[train], y[train]), _moments(X[validation], y[validation])
+
+    results = {}
+    for name, columns in options['subsets']:
+        alphas = grids[name][0]
+        gram, corr, usable, scale = _standardize(train, columns)
+        path = gram_lasso_path(gram, corr, alphas, options['dfmax'])
+        beta = np.zeros((len(path), len(columns)))
+        beta[:, usable] = path / scale
+        sse = np.full(len(alphas), np.nan)
+        sse[:len(path)], sst = _validation_errors(train, validation, columns, beta)
+        results[name] = sse, sst
+    return results
+
+
+def _moments(X, y):
+    return len(y), X.sum(axis=0), y.sum(), X.T.dot(X), X.T.dot(y), y.dot(y)
+
+
+def _standardize(moments, columns):
+    # Gram matrix and correlations of the columns standardized with the moments' means and sds,
+    # dropping constant columns; also returns which columns were kept and their sds
+    num_obs, sum_x, sum_y, xx, xy, _ = moments
+    mean_x = sum_x[columns] / num_obs
+    cov_xx = xx[np.ix_(columns, columns)] / num_obs - np.outer(mean_x, mean_x)
+    cov_xy = xy[columns] / num_obs - mean_x * sum_y / num_obs
+    scale = np.sqrt(np.maximum(np.diag(cov_xx), 0))
+    usable = scale > 1e-12 * np.sqrt(np.diag(xx)[columns] / num_obs)
+    scale = scale[usable]
+    return cov_xx[np.ix_(usable, usable)] / np.outer(scale, scale), cov_xy[usable] / scale, usable, scale
+
+
+def _validation_errors(train, validation, columns, beta):
+    # validation SSE of each row of beta (original feature scale, intercept from the training means)
+    # from the validation moments alone, and the validation SST
+    num_obs, sum_x, sum_y, xx, xy, yy = validation
+    intercept = train[2] / train[0] - beta.dot(train[1][columns] / train[0])
+    sse = (yy - 2 * (intercept * sum_y + beta.dot(xy[columns])) + num_obs * intercept ** 2
+           + 2 * intercept * beta.dot(sum_x[columns])
+           + np.einsum('ij,jk,ik->i', beta, xx[np.ix_(columns, columns)], beta))
+    return sse, yy - sum_y ** 2 / num_obs
+
+
+if __name__ == "__main__":
+    # python model_picker.py factor_signals.csv ticker_signals_arma.csv ticker_data.csv coefs.csv
+    factors, signals, info = load_inputs(sys.argv[1], sys.argv[2], sys.argv[3])
+    print("Starting to fit models")
+    pick_models(factors, signals, info).to_csv(sys.argv[4])
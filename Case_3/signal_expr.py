@@ -0,0 +1,521 @@
+import re
+import numpy as np
+from csv_items import FACTORS, MAX_DELAY, TICKERS
+
+
+def _rolling_std(x):
+    # population std over the trailing MAX_DELAY + 1 observations, nan unless every one of them is
+    # finite; the sums skip missing values (lags start with nan rows) and are taken around the first
+    # finite value, so the E[x^2] - mean^2 difference stays well conditioned on level series
+    window = MAX_DELAY + 1
+    out = np.full(x.shape, np.nan)
+    if len(x) >= window:
+        finite = np.isfinite(x)
+        centered = np.where(finite, x - _first_finite(x), 0)
+        count = _trailing_sum(finite.astype(float), window)
+        mean = _trailing_sum(centered, window) / window
+        variance = _trailing_sum(centered * centered, window) / window - mean ** 2
+        out[window - 1:] = np.where(count == window, np.sqrt(np.maximum(variance, 0)), np.nan)
+    return out
+
+
+def _ar1_fit(x):
+    # fitted values of an AR(1) regression of each column on its own previous value, fitted causally:
+    # row t uses the slope and means of the pairs up to and including row t only, so there is no
+    # look-ahead and the values can be used in walk-forward fits. nan until MAX_DELAY + 1 pairs.
+    out = np.full(x.shape, np.nan)
+    if len(x) < 2:
+        return out
+    shift = _first_finite(x)
+    previous, current = x[:-1] - shift, x[1:] - shift
+    valid = np.isfinite(previous) & np.isfinite(current)
+    previous, current = np.where(valid, previous, 0), np.where(valid, current, 0)
+    count = np.cumsum(valid, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        previous_mean = np.cumsum(previous, axis=0) / count
+        current_mean = np.cumsum(current, axis=0) / count
+        covariance = np.cumsum(previous * current, axis=0) - count * previous_mean * current_mean
+        variance = np.cumsum(previous * previous, axis=0) - count * previous_mean ** 2
+        fitted = current_mean + covariance / variance * (x[:-1] - shift - previous_mean) + shift
+    out[1:] = np.where(count >= MAX_DELAY + 1, fitted, np.nan)
+    return out
+
+
+def _trailing_sum(values, window):
+    # sums over the trailing window along axis 0, for rows window - 1 onwards
+    cumulative = np.concatenate((np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)))
+    return cumulative[window:] - cumulative[:-window]
+
+
+def _first_finite(x):
+    # first finite value of each column (nan for a column without one)
+    first = np.argmax(np.isfinite(x), axis=0)
+    return np.take_along_axis(x, np.expand_dims(first, 0), axis=0)[0]
+
+
+# Unary functions of csv_items.CHANGERS and csv_items.FUNSTUFF; all work along the time axis (axis 0)
+# and only use rows up to the current one
+FUNCTIONS = {
+    "SQRT": np.sqrt,
+    "LOG": np.log,
+    "SQR": np.square,
+    "INV": np.reciprocal,
+    "STDDEV": _rolling_std,
+    "ARMA": _ar1_fit,
+}
+
+# Binary operations of csv_items.OPERATIONS
+OPERATORS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.divide,
+    "%": np.mod,
+}
+
+_TOKEN = re.compile(r"\s*(?:(?P<lag>([A-Za-z0-9_]+)_\{t(?:-(\d+))?\})"
+                    r"|(?P<fun>" + "|".join(sorted(FUNCTIONS, key=len, reverse=True)) + r")\("
+                    r"|(?P<num>\d+(?:\.\d+)?)"
+                    r"|(?P<op>[-+*/%])"
+                    r"|(?P<open>\()"
+                    r"|(?P<close>\)))")
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None:
+            raise ValueError("cannot parse signal {!r} at position {}".format(expression, position))
+        if match.group("lag"):
+            tokens.append(("lag", match.group(2), int(match.group(3) or 0)))
+        elif match.group("fun"):
+            tokens.append(("fun", match.group("fun")))
+        elif match.group("num"):
+            tokens.append(("const", float(match.group("num"))))
+        elif match.group("op"):
+            tokens.append(("op", match.group("op")))
+        elif match.group("open"):
+            tokens.append(("open",))
+        else:
+            tokens.append(("close",))
+        position = match.end()
+    return tokens
+
+
+class SignalGraph:
+    '''
+    Signal expressions such as "SQRT(VIX_{t-1})" or "(OIL_{t-2}/3M_R_{t-4})" parsed into one shared,
+    hash-consed DAG: every distinct subexpression (each lag, each LOG(x), ...) is a single node and is
+    computed once per evaluation, however many signals use it.
+
+    Nodes are tuples ("lag", name, k), ("const", value), ("fun", name, child) and
+    ("op", operator, left, right), with children referred to by node id. Canonical forms (see
+    canonical) also use ("scale", factor, child) for a constant multiple of a subexpression.
+    '''
+
+    def __init__(self):
+        self.nodes = []
+        self.ids = {}
+        self.signals = []
+        self.outputs = []
+        self._canonical = {}
+        self._strings = {}
+
+    def intern(self, node):
+        if node not in self.ids:
+            self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self.ids[node]
+
+    def parse(self, expression):
+        tokens = tokenize(expression)
+        node_id, position = self._parse(tokens, 0, expression)
+        if position != len(tokens):
+            raise ValueError("unexpected trailing input in signal {!r}".format(expression))
+        return node_id
+
+    def _parse(self, tokens, position, expression):
+        if position >= len(tokens):
+            raise ValueError("signal {!r} ends early".format(expression))
+        token = tokens[position]
+        if token[0] == "lag":
+            return self.intern(token), position + 1
+        if token[0] == "const":
+            return self.intern(token), position + 1
+        if token[0] == "fun":
+            child, position = self._parse(tokens, position + 1, expression)
+            position = self._expect(tokens, position, "close", expression)
+            return self.intern(("fun", token[1], child)), position
+        if token[0] == "open":
+            left, position = self._parse(tokens, position + 1, expression)
+            if position >= len(tokens) or tokens[position][0] != "op":
+                raise ValueError("expected an operator in signal {!r}".format(expression))
+            operator = tokens[position][1]
+            right, position = self._parse(tokens, position + 1, expression)
+            position = self._expect(tokens, position, "close", expression)
+            return self.intern(("op", operator, left, right)), position
+        raise ValueError("unexpected {!r} in signal {!r}".format(token, expression))
+
+    def _expect(self, tokens, position, kind, expression):
+        if position >= len(tokens) or tokens[position][0] != kind:
+            raise ValueError("expected {} in signal {!r}".format(kind, expression))
+        return position + 1
+
+    def add(self, expression):
+        node_id = self.parse(expression)
+        self.signals.append(expression)
+        self.outputs.append(node_id)
+        return node_id
+
+    def add_all(self, expressions):
+        for expression in expressions:
+            self.add(expression)
+        return self
+
+    def format(self, node_id):
+        if node_id not in self._strings:
+            node = self.nodes[node_id]
+            kind = node[0]
+            if kind == "lag":
+                string = "{}_{{t-{}}}".format(node[1], node[2]) if node[2] else "{}_{{t}}".format(node[1])
+            elif kind == "const":
+                string = _format_const(node[1])
+            elif kind == "fun":
+                string = "{}({})".format(node[1], self.format(node[2]))
+            elif kind == "scale":
+                string = "({}*{})".format(_format_const(node[1]), self.format(node[2]))
+            else:
+                string = "({}{}{})".format(self.format(node[2]), node[1], self.format(node[3]))
+            self._strings[node_id] = string
+        return self._strings[node_id]
+
+    def canonical(self, node_id):
+        '''
+        Id of the canonical form of a node, built bottom-up in the same table. Constants are folded,
+        identities such as x*1, x/1, SQR(SQRT(x)) and INV(INV(x)) are removed, LOG(INV(x)) becomes
+        -LOG(x), constant factors are pulled out into scale nodes, and the operands of + and * are
+        put in a fixed order, so equivalent signals share one canonical node.
+        '''
+        if node_id not in self._canonical:
+            node = self.nodes[node_id]
+            if node[0] == "fun":
+                result = self._canonical_fun(node[1], self.canonical(node[2]))
+            elif node[0] == "op":
+                result = self._canonical_op(node[1], self.canonical(node[2]), self.canonical(node[3]))
+            elif node[0] == "scale":
+                result = self._scale(node[1], self.canonical(node[2]))
+            else:
+                result = node_id
+            self._canonical[node_id] = result
+            self._canonical[result] = result
+        return self._canonical[node_id]
+
+    def feature_key(self, node_id):
+        '''
+        Canonical node with any overall constant factor dropped: signals with the same key are the
+        same regression feature up to scale (e.g. LOG(INV(x)) and LOG(x), or (x-y) and (y-x)).
+        None for signals that reduce to a constant and so only duplicate the intercept.
+        '''
+        canonical = self.canonical(node_id)
+        if self.nodes[canonical][0] == "const":
+            return None
+        return self._split_scale(canonical)[1]
+
+    def _const(self, value):
+        return self.intern(("const", float(value)))
+
+    def _value(self, node_id):
+        node = self.nodes[node_id]
+        return node[1] if node[0] == "const" else None
+
+    def _split_scale(self, node_id):
+        node = self.nodes[node_id]
+        if node[0] == "scale":
+            return node[1], node[2]
+        return 1.0, node_id
+
+    def _fun_child(self, node_id, name):
+        node = self.nodes[node_id]
+        return node[2] if node[0] == "fun" and node[1] == name else None
+
+    def _scale(self, factor, node_id):
+        value = self._value(node_id)
+        if value is not None:
+            return self._const(factor * value)
+        if factor == 0:
+            return self._const(0)
+        inner_factor, base = self._split_scale(node_id)
+        factor *= inner_factor
+        if factor == 1:
+            return base
+        return self.intern(("scale", float(factor), base))
+
+    def _fun(self, name, node_id):
+        return self.intern(("fun", name, node_id))
+
+    def _ordered(self, operator, a, b):
+        if self.format(a) > self.format(b):
+            a, b = b, a
+        return self.intern(("op", operator, a, b))
+
+    def _canonical_fun(self, name, x):
+        value = self._value(x)
+        if value is not None:
+            if name == "STDDEV":
+                return self._const(0)
+            if name == "ARMA":
+                return x
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return self._const(FUNCTIONS[name](value))
+        factor, base = self._split_scale(x)
+        if name == "SQR":
+            if factor != 1:
+                return self._scale(factor * factor, self._canonical_fun("SQR", base))
+            if self._fun_child(x, "SQRT") is not None:
+                return self._fun_child(x, "SQRT")
+            if self._fun_child(x, "INV") is not None:
+                return self._canonical_fun("INV", self._canonical_fun("SQR", self._fun_child(x, "INV")))
+        elif name == "INV":
+            if factor != 1:
+                return self._scale(1 / factor, self._canonical_fun("INV", base))
+            if self._fun_child(x, "INV") is not None:
+                return self._fun_child(x, "INV")
+        elif name == "SQRT":
+            if factor > 0 and factor != 1:
+                return self._scale(np.sqrt(factor), self._canonical_fun("SQRT", base))
+            if self._fun_child(x, "INV") is not None:
+                return self._canonical_fun("INV", self._canonical_fun("SQRT", self._fun_child(x, "INV")))
+        elif name == "LOG":
+            if self._fun_child(x, "INV") is not None:
+                return self._scale(-1, self._canonical_fun("LOG", self._fun_child(x, "INV")))
+            if self._fun_child(x, "SQRT") is not None:
+                return self._scale(0.5, self._canonical_fun("LOG", self._fun_child(x, "SQRT")))
+        elif name == "STDDEV":
+            if factor != 1:
+                return self._scale(abs(factor), self._canonical_fun("STDDEV", base))
+        elif name == "ARMA":
+            # fitted AR(1) values scale with their input
+            if factor != 1:
+                return self._scale(factor, self._canonical_fun("ARMA", base))
+        return self._fun(name, x)
+
+    def _canonical_op(self, operator, a, b):
+        value_a, value_b = self._value(a), self._value(b)
+        if value_a is not None and value_b is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return self._const(OPERATORS[operator](value_a, value_b))
+        factor_a, base_a = self._split_scale(a)
+        factor_b, base_b = self._split_scale(b)
+        if operator == "+":
+            if value_a == 0:
+                return b
+            if value_b == 0:
+                return a
+            if base_a == base_b:
+                return self._scale(factor_a + factor_b, base_a)
+            if factor_b < 0:
+                return self._canonical_op("-", a, self._scale(-1, b))
+            if factor_a < 0:
+                return self._canonical_op("-", b, self._scale(-1, a))
+            return self._ordered("+", a, b)
+        if operator == "-":
+            if value_b == 0:
+                return a
+            if value_a == 0:
+                return self._scale(-1, b)
+            if base_a == base_b:
+                return self._scale(factor_a - factor_b, base_a)
+            if factor_b < 0:
+                return self._canonical_op("+", a, self._scale(-1, b))
+            # (y-x) is -(x-y): orient the difference and keep the sign outside
+            if self.format(a) > self.format(b):
+                return self._scale(-1, self.intern(("op", "-", b, a)))
+            return self.intern(("op", "-", a, b))
+        if operator == "*":
+            if value_a is not None:
+                return self._scale(value_a, b)
+            if value_b is not None:
+                return self._scale(value_b, a)
+            if factor_a * factor_b != 1 or factor_a != 1:
+                return self._scale(factor_a * factor_b, self._canonical_op("*", base_a, base_b))
+            if base_a == base_b:
+                return self._canonical_fun("SQR", base_a)
+            if self._fun_child(b, "INV") is not None:
+                return self._canonical_op("/", a, self._fun_child(b, "INV"))
+            if self._fun_child(a, "INV") is not None:
+                return self._canonical_op("/", b, self._fun_child(a, "INV"))
+            return self._ordered("*", a, b)
+        if operator == "/":
+            if value_b is not None:
+                return self._scale(1 / value_b, a) if value_b != 0 else self._const(np.nan)
+            if value_a is not None:
+                return self._scale(value_a, self._canonical_fun("INV", b))
+            if factor_a != 1 or factor_b != 1:
+                return self._scale(factor_a / factor_b, self._canonical_op("/", base_a, base_b))
+            if a == b:
+                return self._const(1)
+            if self._fun_child(b, "INV") is not None:
+                return self._canonical_op("*", a, self._fun_child(b, "INV"))
+            return self.intern(("op", "/", a, b))
+        if a == b:
+            return self._const(0)
+        return self.intern(("op", operator, a, b))
+
+    def evaluate(self, data, out=None, functions=None):
+        '''
+        Evaluates every added signal over data, a mapping from factor/ticker field name to an array
+        with time along axis 0: shape (T,) for one ticker, or (T, N) for a panel of N tickers, where
+        (T,) factor arrays are shared by all tickers. Returns out, of shape data shape + (num signals,),
+        allocated if not given. Intermediate results are dropped as soon as nothing else needs them.
+        '''
+        functions = FUNCTIONS if functions is None else dict(FUNCTIONS, **functions)
+        shape = _panel_shape(data)
+        if out is None:
+            out = np.empty(shape + (len(self.outputs),))
+
+        # how many times each node is still needed, by parents and by output columns
+        needed = np.zeros(len(self.nodes), dtype=bool)
+        needed[self.outputs] = True
+        remaining = np.zeros(len(self.nodes), dtype=int)
+        for node_id in range(len(self.nodes) - 1, -1, -1):
+            if needed[node_id]:
+                for child in _children(self.nodes[node_id]):
+                    needed[child] = True
+                    remaining[child] += 1
+        columns = {}
+        for column, node_id in enumerate(self.outputs):
+            columns.setdefault(node_id, []).append(column)
+            remaining[node_id] += 1
+
+        values = {}
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for node_id in np.flatnonzero(needed):
+                node = self.nodes[node_id]
+                values[node_id] = self._evaluate_node(node, values, data, shape, functions)
+                for child in _children(node):
+                    remaining[child] -= 1
+                    if not remaining[child]:
+                        del values[child]
+                for column in columns.get(node_id, ()):
+                    out[..., column] = values[node_id]
+                    remaining[node_id] -= 1
+                if not remaining[node_id]:
+                    del values[node_id]
+        return out
+
+    def _evaluate_node(self, node, values, data, shape, functions):
+        kind = node[0]
+        if kind == "lag":
+            return _lag(_broadcast_field(data, node[1], shape), node[2])
+        if kind == "const":
+            return node[1]
+        if kind == "fun":
+            argument = values[node[2]]
+            if np.ndim(argument) == 0:
+                argument = np.full((shape[0],) + (1,) * (len(shape) - 1), argument)
+            # factor-only arguments keep their (T, 1) shape, so they are transformed once, not per ticker
+            return functions[node[1]](argument)
+        if kind == "scale":
+            return node[1] * values[node[2]]
+        return OPERATORS[node[1]](values[node[2]], values[node[3]])
+
+
+def build_feature_matrix(signals, data, out=None, functions=None):
+    return SignalGraph().add_all(signals).evaluate(data, out=out, functions=functions)
+
+
+def dedupe_signals(signals, graph=None):
+    '''
+    Drops signals that are algebraically the same feature as an earlier one (up to a constant
+    factor) or that reduce to a constant. Works on any iterable, e.g. the csv_items generators.
+    Returns the kept signals and a report of how many candidates were eliminated and why.
+    '''
+    graph = SignalGraph() if graph is None else graph
+    seen = set()
+    kept = []
+    report = {"candidates": 0, "kept": 0, "eliminated": 0, "duplicates": 0, "degenerate": 0}
+    for signal in signals:
+        report["candidates"] += 1
+        key = graph.feature_key(graph.parse(signal))
+        if key is None:
+            report["degenerate"] += 1
+        elif key in seen:
+            report["duplicates"] += 1
+        else:
+            seen.add(key)
+            kept.append(signal)
+    report["kept"] = len(kept)
+    report["eliminated"] = report["duplicates"] + report["degenerate"]
+    return kept, report
+
+
+def _format_const(value):
+    # the signal grammar has no unary minus, nan or inf, so negative constants are written as
+    # differences and non-finite ones (folded from e.g. x/LOG(1)) as the divisions they fold back from
+    if np.isnan(value):
+        return "(0/0)"
+    if value < 0:
+        return "(0-{})".format(_format_const(-value))
+    if np.isinf(value):
+        return "(1/0)"
+    return "{:g}".format(value)
+
+
+def _children(node):
+    if node[0] == "fun" or node[0] == "scale":
+        return (node[2],)
+    if node[0] == "op":
+        return (node[2], node[3])
+    return ()
+
+
+def _panel_shape(data):
+    shapes = [np.shape(values) for values in data.values()]
+    num_steps = shapes[0][0]
+    if any(shape[0] != num_steps for shape in shapes):
+        raise ValueError("all fields must have the same number of time steps")
+    widths = set(shape[1] for shape in shapes if len(shape) == 2)
+    if len(widths) > 1:
+        raise ValueError("all panel fields must have the same number of tickers")
+    return (num_steps,) + tuple(widths)
+
+
+def _broadcast_field(data, name, shape):
+    if name not in data:
+        raise KeyError("no data for signal field {!r}".format(name))
+    values = np.asarray(data[name], dtype=float)
+    if values.ndim < len(shape):
+        values = values.reshape((len(values),) + (1,) * (len(shape) - values.ndim))
+    return values
+
+
+def _lag(values, k):
+    if k == 0:
+        return values
+    lagged = np.empty(values.shape)
+    lagged[:k] = np.nan
+    lagged[k:] = values[:-k]
+    return lagged
+
+
+if __name__ == "__main__":
+    # evaluate the signals of test_case_3_1.txt on random data and check the rolling functions are
+    # defined once their window has filled
+    signals = [line.strip() for line in open("test_case_3_1.txt") if line.strip()]
+    rng = np.random.RandomState(0)
+    data = dict((factor, np.exp(np.cumsum(rng.randn(60)) * 0.05)) for factor in FACTORS if factor != "1")
+    data.update((field, np.abs(rng.randn(60, 3)) + 0.5) for field in TICKERS)
+    values = build_feature_matrix(signals, data)
+    stddev = values[..., signals.index("STDDEV(VIX_{t-1})")]
+    assert np.isfinite(stddev[MAX_DELAY + 1:]).all() and np.isnan(stddev[:MAX_DELAY + 1]).all()
+    undefined = [signal for column, signal in enumerate(signals) if not np.isfinite(values[..., column]).any()]
+    print("{} signals, {} never defined".format(len(signals), len(undefined)))
+
+    # canonical forms, including constants folded to nan or inf, format back into the grammar
+    graph = SignalGraph()
+    for signal in signals + ["(VIX_{t-1}/LOG(1))", "(1/LOG(1))", "(0-(1/LOG(1)))", "(OIL_{t-2}*(2/LOG(1)))"]:
+        formatted = graph.format(graph.canonical(graph.parse(signal)))
+        assert graph.format(graph.canonical(graph.parse(formatted))) == formatted, signal
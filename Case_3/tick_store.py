@@ -0,0 +1,106 @@
+import collections
+import json
+import os
+import numpy as np
+import pandas as pd
+
+COLUMNS = (("timestamp", np.int64), ("price", np.float64), ("volume", np.float64))
+
+TickSlice = collections.namedtuple("TickSlice", ["timestamps", "prices", "volumes"])
+
+
+def ingest_csv(csv_path, store_dir, chunksize=1000000):
+    '''
+    One-time conversion of a btce-style tick file (epoch seconds, price, volume, no header) into
+    flat binary columns plus a per-day row index. The csv is streamed in chunks, so the whole file
+    is never held in memory, and it must already be in time order.
+    '''
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    files = dict((name, open(os.path.join(store_dir, name + ".bin"), "wb")) for name, _ in COLUMNS)
+    num_rows = 0
+    last_timestamp = None
+    days = []
+    day_starts = []
+    try:
+        reader = pd.read_csv(csv_path, names=[name for name, _ in COLUMNS], chunksize=chunksize)
+        for chunk in reader:
+            timestamps = chunk["timestamp"].values.astype(np.int64)
+            if len(timestamps) == 0:
+                continue
+            if np.any(np.diff(timestamps) < 0) or (last_timestamp is not None and timestamps[0] < last_timestamp):
+                raise ValueError("tick file is not sorted by timestamp")
+            chunk_days = timestamps // 86400
+            new_day = np.concatenate(([last_timestamp is None or chunk_days[0] != last_timestamp // 86400],
+                                      chunk_days[1:] != chunk_days[:-1]))
+            days.append(chunk_days[new_day])
+            day_starts.append(num_rows + np.flatnonzero(new_day))
+            for name, dtype in COLUMNS:
+                chunk[name].values.astype(dtype).tofile(files[name])
+            num_rows += len(timestamps)
+            last_timestamp = timestamps[-1]
+    finally:
+        for f in files.values():
+            f.close()
+
+    days = np.concatenate(days) if days else np.empty(0, dtype=np.int64)
+    day_starts = np.concatenate(day_starts) if day_starts else np.empty(0, dtype=np.int64)
+    np.save(os.path.join(store_dir, "day_index.npy"), np.column_stack((days, day_starts)).astype(np.int64))
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump({"num_rows": num_rows, "columns": [name for name, _ in COLUMNS]}, f)
+    return TickStore(store_dir)
+
+
+class TickStore:
+    '''
+    Read side of a store written by ingest_csv. Columns are memory-mapped on first use and load
+    returns views into them, so only the pages of the requested date range are ever read.
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            self.num_rows = json.load(f)["num_rows"]
+        self._columns = {}
+        self._day_index = None
+
+    def column(self, name):
+        if name not in self._columns:
+            dtype = dict(COLUMNS)[name]
+            if self.num_rows:
+                self._columns[name] = np.memmap(os.path.join(self.store_dir, name + ".bin"), dtype=dtype,
+                                                mode="r", shape=(self.num_rows,))
+            else:
+                self._columns[name] = np.empty(0, dtype=dtype)
+        return self._columns[name]
+
+    def row_range(self, start=None, end=None):
+        '''Rows from the first tick on or after the start date up to, not including, the end date.'''
+        if self._day_index is None:
+            self._day_index = np.load(os.path.join(self.store_dir, "day_index.npy"))
+        days, day_starts = self._day_index[:, 0], self._day_index[:, 1]
+        first, last = 0, self.num_rows
+        if start is not None:
+            i = np.searchsorted(days, _to_epoch_day(start))
+            first = day_starts[i] if i < len(days) else self.num_rows
+        if end is not None:
+            i = np.searchsorted(days, _to_epoch_day(end))
+            last = day_starts[i] if i < len(days) else self.num_rows
+        return first, max(first, last)
+
+    def load(self, start=None, end=None):
+        first, last = self.row_range(start, end)
+        return TickSlice(self.column("timestamp")[first:last].view("datetime64[s]"),
+                         self.column("price")[first:last],
+                         self.column("volume")[first:last])
+
+    def load_frame(self, start=None, end=None, columns=("Price",)):
+        # DataFrame in the layout the backtest notebook used to build from the csv
+        ticks = self.load(start, end)
+        data = {"Price": ticks.prices, "Volume": ticks.volumes}
+        return pd.DataFrame(dict((name, data[name]) for name in columns),
+                            index=pd.DatetimeIndex(ticks.timestamps, name="Datetime"), columns=list(columns))
+
+
+def _to_epoch_day(date):
+    return np.datetime64(pd.Timestamp(date).date(), "D").astype(np.int64)